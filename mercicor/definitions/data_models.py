@@ -0,0 +1,38 @@
+"""Data models of the tables, read once from the CSV files."""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from functools import lru_cache
+from typing import NamedTuple, Tuple
+
+from mercicor.qgis_plugin_tools import load_csv, resources_path
+
+
+class DataModelField(NamedTuple):
+    """ Field of a table, as described in its CSV file. """
+    name: str
+    field_type: int
+    comment: str
+    alias: str
+
+
+@lru_cache(maxsize=None)
+def data_model(table: str) -> Tuple[DataModelField, ...]:
+    """ Fields of the table, the CSV file is read only on the first call. """
+    path = resources_path('data_models', '{}.csv'.format(table))
+    csv = load_csv(table, path)
+    return tuple(
+        DataModelField(
+            feature['name'],
+            int(feature['type']),
+            feature['comment'],
+            feature['alias'],
+        ) for feature in csv.getFeatures()
+    )
+
+
+def field_names(table: str) -> Tuple[str, ...]:
+    """ Names of the fields of the table. """
+    return tuple(field.name for field in data_model(table))
@@ -6,11 +6,16 @@ from os.path import join
 from qgis.PyQt.QtCore import QVariant
 
 from mercicor.definitions.joins import spatial_joins
-from mercicor.definitions.relations import Relation, relations
+from mercicor.definitions.relations import (
+    Relation,
+    relations_compensation,
+    relations_pression,
+)
 from mercicor.definitions.tables import tables
-from mercicor.qgis_plugin_tools import load_csv, resources_path
+from mercicor.qgis_plugin_tools import load_csv, plugin_path, resources_path
 
-PATH = '/model'
+# Relations of both project types, without duplicates
+relations = relations_pression + [r for r in relations_compensation if r not in relations_pression]
 
 TEMPLATE = '''---
 hide:
@@ -154,8 +159,7 @@ def generate_model_doc():  # NOQA C901
     mermaid_md += '```'
     markdown_all = markdown_all.format(relationships=mermaid_md)
 
-    output_file = join(PATH, 'README.md')
-    output_file = '/home/etienne/dev/python/qgis-mercicor-plugin/docs/model/index.md'
+    output_file = join(plugin_path(), '..', 'docs', 'model', 'index.md')
     text_file = open(output_file, "w+")
     text_file.write(markdown_all)
     text_file.close()
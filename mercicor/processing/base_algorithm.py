@@ -87,3 +87,11 @@ class BaseProcessingAlgorithm(QgsProcessingAlgorithm):
             return False, message
 
         return True, ''
+
+    @staticmethod
+    def check_layer_has_no_pending_edits(layer: QgsMapLayer) -> Tuple[bool, str]:
+        """ Check that the layer has no edits to save, they must not be saved or lost by the algorithm. """
+        if layer.isEditable() and layer.isModified():
+            return False, 'La couche {} a des modifications non enregistrées'.format(layer.name())
+
+        return True, ''
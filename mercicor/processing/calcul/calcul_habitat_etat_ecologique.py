@@ -2,18 +2,30 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-import processing
+from collections import OrderedDict
+from typing import Tuple
 
 from qgis.core import (
     QgsFeature,
+    QgsFeatureRequest,
     QgsProcessing,
+    QgsProcessingException,
+    QgsProcessingParameterString,
     QgsProcessingParameterVectorLayer,
-    QgsProcessingUtils,
-    QgsVectorLayer,
+    QgsRectangle,
 )
 from qgis.PyQt.QtCore import QVariant
 
 from mercicor.processing.calcul.base import CalculAlgorithm
+from mercicor.processing.calcul.notes_engine import (
+    INDICATORS,
+    NOTES,
+    STATION_MAN,
+    compute_feature_notes,
+)
+from mercicor.processing.calcul.unicity_cache import check_unicity
+from mercicor.processing.spatial_join import PointIndex
+from mercicor.processing.utils import BATCH_SIZE, chunks, is_null
 
 
 class CalculHabitatEtatEcologique(CalculAlgorithm):
@@ -21,10 +33,11 @@ class CalculHabitatEtatEcologique(CalculAlgorithm):
     HABITAT = 'HABITAT'
     OBSERVATIONS = 'OBSERVATIONS'
     HABITAT_ETAT_ECOLOGIQUE = 'HABITAT_ETAT_ECOLOGIQUE'
+    OBSERVATION_IDS = 'OBSERVATION_IDS'
 
     def checkParameterValues(self, parameters, context):
         """
-        Check if source layer is in the geopackage
+        Check if source layer is in the geopackage and the destination has no pending edits
         """
         sources = [
             self.parameterAsVectorLayer(parameters, self.HABITAT, context),
@@ -36,6 +49,16 @@ class CalculHabitatEtatEcologique(CalculAlgorithm):
             if not flag:
                 return False, msg
 
+        hab_etat_ecolo = sources[-1]
+        flag, msg = self.check_layer_has_no_pending_edits(hab_etat_ecolo)
+        if not flag:
+            return False, msg
+
+        try:
+            self.observation_ids(parameters, context)
+        except ValueError:
+            return False, 'Les identifiants des observations doivent être des entiers séparés par une virgule'
+
         return super().checkParameterValues(parameters, context)
 
     def name(self):
@@ -50,8 +73,10 @@ class CalculHabitatEtatEcologique(CalculAlgorithm):
             'à partir des données d\'observations :\n'
             '- Vérification de l\'unicité du facies\n'
             '- Jointure de données\n'
-            '- Calcul des notes'
-
+            '- Calcul des notes\n\n'
+            'Après l\'import de quelques observations, il est possible de ne mettre à jour que '
+            'les habitats de ces observations. Si une observation a été déplacée ou supprimée, '
+            'il faut mettre à jour tous les habitats.'
         )
 
     def initAlgorithm(self, config):
@@ -83,22 +108,30 @@ class CalculHabitatEtatEcologique(CalculAlgorithm):
             )
         )
 
+        parameter = QgsProcessingParameterString(
+            self.OBSERVATION_IDS,
+            'Identifiants des observations ajoutées ou modifiées',
+            optional=True,
+        )
+        self.set_tooltip_parameter(
+            parameter,
+            'Liste des identifiants des observations, séparés par une virgule. Seuls les habitats de '
+            'ces observations sont mis à jour. Tous les habitats sont mis à jour si la liste est vide.')
+        self.addParameter(parameter)
+
+    def observation_ids(self, parameters, context) -> list:
+        """ List of added or edited observation IDs, empty for all observations. """
+        observation_ids = self.parameterAsString(parameters, self.OBSERVATION_IDS, context)
+        return [int(fid) for fid in observation_ids.split(',') if fid.strip()]
+
     def processAlgorithm(self, parameters, context, feedback):
         hab_layer = self.parameterAsVectorLayer(parameters, self.HABITAT, context)
         observ_layer = self.parameterAsVectorLayer(parameters, self.OBSERVATIONS, context)
         hab_etat_ecolo = self.parameterAsVectorLayer(parameters, self.HABITAT_ETAT_ECOLOGIQUE, context)
 
         # Vérification de l'unicité de la couche habitat pour le couple nom/faciès
-        params = {
-            'INPUT': hab_layer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "mercicor:calcul_unicity_habitat",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
+        # Le résultat est réutilisé si la couche habitat n'a pas changé
+        results = check_unicity(hab_layer, context, feedback)
 
         if results['NUMBER_OF_NON_UNIQUE']:
             feedback.pushDebugInfo(
@@ -113,133 +146,194 @@ class CalculHabitatEtatEcologique(CalculAlgorithm):
             feedback.pushInfo(msg)
             return {}
 
-        # Calcul de la moyenne des indicateurs mercicor par habitat/faciès
-        params = {
-            'DISCARD_NONMATCHING': True,
-            'INPUT': hab_layer,
-            'JOIN': observ_layer,
-            'JOIN_FIELDS': [
-                'perc_bsd', 'perc_bsm', 'bsd_recouv_cor', 'bsd_p_acrop', 'bsd_vital_cor',
-                'bsd_comp_struc', 'bsd_taille_cor', 'bsd_dens_juv', 'bsd_f_sessile',
-                'bsd_recouv_ma', 'bsm_fragm_herb', 'bsm_recouv_her', 'bsm_haut_herb',
-                'bsm_dens_herb', 'bsm_div_herb', 'bsm_epibiose', 'man_fragm',
-                'man_recouv', 'man_diam_tronc', 'man_dens', 'man_diversit',
-                'man_vital', 'pmi_div_poi', 'pmi_predat_poi', 'pmi_scarib_poi', 'pmi_macro_inv'
-            ],
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-            'PREDICATE': [0],  # Intersects
-            'SUMMARIES': [6]  # Mean
-        }
-
-        results = processing.run(
-            "qgis:joinbylocationsummary",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+        # Habitats à mettre à jour, ceux des observations ajoutées ou modifiées
+        habitat_ids = None
+        extent = None
+        observation_ids = self.observation_ids(parameters, context)
+        if observation_ids:
+            habitat_ids, extent = self.habitats_of_observations(
+                hab_layer, observ_layer, observation_ids, context.transformContext())
+            feedback.pushInfo('{} habitat(s) à mettre à jour'.format(len(habitat_ids)))
+            if not habitat_ids:
+                return {}
+
+        # Calcul de la moyenne des indicateurs mercicor et de l'information de station
+        # en Mangrove par habitat/faciès, en une seule passe sur les observations
+        summaries = self.summarize_observations(
+            hab_layer, observ_layer, context.transformContext(), feedback, habitat_ids, extent)
 
         # Mise en forme du résultat pour enregistrement dans la table habitat_etat_ecologique
         hee_fields = hab_etat_ecolo.fields()
         hee_features = {}
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-        for feat in layer.getFeatures():
+        for feat, values in summaries:
             hee_feature = QgsFeature(hee_fields)
             hee_feature.setAttribute('id', feat['id'])
             hee_feature.setAttribute('nom', feat['nom'])
             hee_feature.setAttribute('facies', feat['facies'])
-            for field in params['JOIN_FIELDS']:
-                hee_feature.setAttribute(field, feat[field+'_mean'])
+            for field, value in values.items():
+                hee_feature.setAttribute(field, value)
             hee_features[feat['id']] = hee_feature
 
-        # Récupération de l'information de station en Mangrove
-        params = {
-            'DISCARD_NONMATCHING': True,
-            'INPUT': hab_layer,
-            'JOIN': observ_layer,
-            'JOIN_FIELDS': ['station_man'],
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-            'PREDICATE': [0],  # Intersects
-            'SUMMARIES': [3]  # Max
-        }
-
-        results = processing.run(
-            "qgis:joinbylocationsummary",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+        # Calcul des notes mercicor, directement sur les objets qui seront
+        # enregistrés dans la table habitat_etat_ecologique
+        features = list(hee_features.values())
+        notes = compute_feature_notes(features, hee_fields)
+        note_indexes = [(note, hee_fields.indexOf(note)) for note in NOTES]
+        note_indexes = [(note, index) for note, index in note_indexes if index >= 0]
+        # forcer les valeurs booléenne
+        bool_indexes = [i for i, field in enumerate(hee_fields) if field.type() == QVariant.Bool]
+        for i, hee_feature in enumerate(features):
+            for note, index in note_indexes:
+                hee_feature.setAttribute(index, notes[note][i])
+            for index in bool_indexes:
+                field_val = hee_feature[index]
+                hee_feature.setAttribute(index, 1 if field_val and str(field_val).lower() == 'true' else 0)
+
+        # Enregistrement dans la table habitat_etat_ecologique
+        self.upsert(hab_etat_ecolo, hee_features, BATCH_SIZE, feedback)
+        hab_etat_ecolo.reloadData()
 
-        # Ajout de l'information de station en Mangrove aux objets qui
-        # seront enregistrés dans la table habitat_etat_ecologique
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-        for feat in layer.getFeatures():
-            hee_feature = hee_features[feat['id']]
-            for field in params['JOIN_FIELDS']:
-                hee_feature.setAttribute(field, feat[field+'_max'])
-            hee_features[feat['id']] = hee_feature
+        return {}
 
-        # Création d'une couche temporaire pour calcul des notes mercicor
-        layer = QgsVectorLayer("None", "temporary_hee", "memory")
-        pr = layer.dataProvider()
-        pr.addAttributes(hee_fields)
-        layer.updateFields()
-        pr.addFeatures(list(hee_features.values()))
-
-        # Calcul des notes mercicor
-        params = {
-            'INPUT': layer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "mercicor:calcul_notes",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
+    @staticmethod
+    def upsert(layer, features: dict, batch_size: int, feedback) -> None:
+        """ Update the existing features having the same ID and add the others.
 
-        # Ajout des notes mercicor aux objets qui seront enregistrés
-        # dans la table habitat_etat_ecologique
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-        layer_fields = layer.fields()
-        for feat in layer.getFeatures():
-            hee_feature = hee_features[feat['id']]
-            for field in layer_fields:
-                field_name = field.name()
-                if hee_fields.indexOf(field_name) < 0:
+        :param features: Features to write, by ID, with the fields of the layer.
+        """
+        provider = layer.dataProvider()
+        fields = provider.fields()
+
+        # Correspondance des index des champs, calculée une seule fois
+        indexes = []
+        for i, field in enumerate(layer.fields()):
+            index = fields.indexOf(field.name())
+            if index >= 0:
+                indexes.append((index, i))
+
+        # Seuls les objets existants ayant un identifiant calculé sont lus
+        remaining = dict(features)
+        for ids in chunks(features.keys(), batch_size):
+            if feedback.isCanceled():
+                return
+
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes(['id'], fields)
+            request.setFilterExpression('"id" IN ({})'.format(', '.join([str(int(i)) for i in ids])))
+
+            changes = {}
+            for existing in provider.getFeatures(request):
+                feature = remaining.pop(existing['id'], None)
+                if feature is None:
                     continue
-                field_val = feat[field_name]
-                # forcer les valeurs booléenne
-                if field.type() == QVariant.Bool:
-                    if field_val and str(field_val).lower() == 'true':
-                        field_val = 1
-                    else:
-                        field_val = 0
-                #  set attribute
-                hee_feature.setAttribute(field_name, field_val)
-            hee_features[feat['id']] = hee_feature
-
-        # Début de la modification de la table habitat_etat_ecologique
-        hab_etat_ecolo.startEditing()
+                attributes = feature.attributes()
+                changes[existing.id()] = {index: attributes[i] for index, i in indexes}
+
+            if changes and not provider.changeAttributeValues(changes):
+                raise QgsProcessingException(
+                    'Erreur lors de la mise à jour de la table {} : {}'.format(
+                        layer.name(), ', '.join(provider.errors())))
+
+        # Ajout des objets restant
+        if remaining:
+            result, _ = provider.addFeatures(list(remaining.values()))
+            if not result:
+                raise QgsProcessingException(
+                    'Erreur lors de l\'ajout dans la table {} : {}'.format(
+                        layer.name(), ', '.join(provider.errors())))
+
+    @staticmethod
+    def habitats_of_observations(
+            hab_layer, observ_layer, observation_ids: list, transform_context) -> Tuple[list, QgsRectangle]:
+        """ IDs and extent of the habitats intersecting the given observations. """
+        request = QgsFeatureRequest()
+        request.setNoAttributes()
+        request.setFilterExpression(
+            '"id" IN ({})'.format(', '.join([str(i) for i in observation_ids])))
+        request.setDestinationCrs(hab_layer.crs(), transform_context)
+
+        habitat_ids = []
+        seen = set()
+        extent = QgsRectangle()
+        extent.setMinimal()
+        for observation in observ_layer.getFeatures(request):
+            if not observation.hasGeometry():
+                continue
+
+            # L'index spatial de la couche habitat est utilisé par le filtre sur l'emprise
+            geometry = observation.geometry()
+            hab_request = QgsFeatureRequest()
+            hab_request.setNoAttributes()
+            hab_request.setFilterRect(geometry.boundingBox())
+            for habitat in hab_layer.getFeatures(hab_request):
+                if habitat.id() in seen or not habitat.geometry().intersects(geometry):
+                    continue
+                seen.add(habitat.id())
+                habitat_ids.append(habitat.id())
+                extent.combineExtentWith(habitat.geometry().boundingBox())
 
-        # Mise à jour des objets de la table habitat_etat_ecologique
-        for existing in hab_etat_ecolo.getFeatures():
-            if existing['id'] in hee_features:
-                feat = hee_features[existing['id']]
-                attributes = dict()
-                for field in hee_fields:
-                    field_name = field.name()
-                    attributes[hee_fields.indexOf(field_name)] = feat[field_name]
-                hab_etat_ecolo.changeAttributeValues(existing.id(), attributes)
-                del hee_features[existing['id']]
+        return habitat_ids, extent
 
-        # Ajout des objets restant de la table habitat_etat_ecologique
-        for feat in hee_features.values():
-            hab_etat_ecolo.addFeature(feat)
+    @staticmethod
+    def summarize_observations(
+            hab_layer, observ_layer, transform_context, feedback,
+            habitat_ids: list = None, extent: QgsRectangle = None) -> list:
+        """ Mean of the indicators and max of station_man of the observations in each habitat.
 
-        # Fin et enregistrement de la modification de la table habitat_etat_ecologique
-        hab_etat_ecolo.commitChanges()
+        The habitats without observation are discarded, like the join by location summary.
 
-        return {}
+        :param habitat_ids: IDs of the habitats to summarize, all habitats if None.
+        :param extent: Extent of these habitats, to read only the observations inside.
+        :return: List of habitat features with the summary of their observations.
+        """
+        observ_fields = observ_layer.fields()
+        indicator_indexes = [(field, observ_fields.indexOf(field)) for field in INDICATORS]
+        station_man_index = observ_fields.indexOf(STATION_MAN)
+
+        # Un index négatif lirait une autre colonne
+        missing = [field for field, field_index in indicator_indexes if field_index < 0]
+        if station_man_index < 0:
+            missing.append(STATION_MAN)
+        if missing:
+            raise QgsProcessingException(
+                'Champ(s) manquant(s) dans la couche {} : {}'.format(observ_layer.name(), ', '.join(missing)))
+
+        # Index spatial des observations, dans le CRS de la couche habitat
+        index = PointIndex(
+            observ_layer, hab_layer.crs(), transform_context, list(INDICATORS) + [STATION_MAN], feedback,
+            extent)
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(['id', 'nom', 'facies'], hab_layer.fields())
+        if habitat_ids is not None:
+            request.setFilterFids(habitat_ids)
+
+        summaries = []
+        for hab_feature, fids in index.matches(hab_layer.getFeatures(request), feedback):
+            if not fids:
+                continue
+
+            sums = dict.fromkeys(INDICATORS, 0.0)
+            counts = dict.fromkeys(INDICATORS, 0)
+            station_man = None
+            for fid in fids:
+                attributes = index.feature(fid).attributes()
+                for field, field_index in indicator_indexes:
+                    value = attributes[field_index]
+                    if not is_null(value):
+                        sums[field] += float(value)
+                        counts[field] += 1
+
+                value = attributes[station_man_index]
+                if not is_null(value):
+                    value = str(value).lower() in ('true', '1')
+                    station_man = value if station_man is None else station_man or value
+
+            values = OrderedDict()
+            for field in INDICATORS:
+                values[field] = sums[field] / counts[field] if counts[field] else None
+            values[STATION_MAN] = station_man
+            summaries.append((hab_feature, values))
+
+        return summaries
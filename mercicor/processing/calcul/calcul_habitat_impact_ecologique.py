@@ -2,23 +2,36 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-from typing import Optional, Tuple, Union
-
-import processing
+from typing import NamedTuple, Tuple, Union
 
 from qgis.core import (
     QgsExpression,
     QgsFeature,
     QgsFeatureRequest,
+    QgsField,
+    QgsFields,
     QgsProcessing,
+    QgsProcessingException,
     QgsProcessingMultiStepFeedback,
+    QgsProcessingOutputNumber,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterNumber,
     QgsProcessingParameterVectorLayer,
-    QgsProcessingUtils,
-    edit,
 )
+from qgis.PyQt.QtCore import QVariant
 
 from mercicor.definitions.project_type import ProjectType
 from mercicor.processing.calcul.base import CalculAlgorithm
+from mercicor.processing.geometry import GeometryRepair
+from mercicor.processing.overlay import intersection_by_group
+from mercicor.processing.utils import BATCH_SIZE, chunks
+
+
+class ColumnMapping(NamedTuple):
+    # Index des champs de l'intersection et de la couche de destination
+    indexes: tuple
+    # Index dans la couche de destination des champs mis à 0 pour une emprise
+    zero_indexes: frozenset
 
 
 class BaseCalculHabitatImpactEtatEcologique(CalculAlgorithm):
@@ -35,9 +48,16 @@ class BaseCalculHabitatImpactEtatEcologique(CalculAlgorithm):
         )
 
     HABITAT_LAYER = 'HABITAT_LAYER'
+    SCENARIO_ID = 'SCENARIO_ID'
+    DELETE_OUTDATED = 'DELETE_OUTDATED'
+    NUMBER_OF_REPAIRED = 'NUMBER_OF_REPAIRED'
+
+    # Champ de la surface de l'entité
+    SURFACE = 'surface'
 
     def __init__(self):
         self.output_layer = None
+        self.number_of_repaired = 0
         super().__init__()
 
     @property
@@ -108,6 +128,36 @@ class BaseCalculHabitatImpactEtatEcologique(CalculAlgorithm):
             parameter, self.project_type.label_habitat_impact_etat_ecologique)
         self.addParameter(parameter)
 
+        parameter = QgsProcessingParameterNumber(
+            self.SCENARIO_ID,
+            'Identifiant du scénario',
+            QgsProcessingParameterNumber.Integer,
+            optional=True,
+        )
+        self.set_tooltip_parameter(
+            parameter,
+            'Seules les entités de la {} de ce scénario sont traitées. '
+            'Tous les scénarios sont traités si le champ est vide.'.format(self.project_type.label))
+        self.addParameter(parameter)
+
+        parameter = QgsProcessingParameterBoolean(
+            self.DELETE_OUTDATED,
+            'Supprimer les entités qui ne sont plus dans l\'intersection',
+            defaultValue=False,
+        )
+        self.set_tooltip_parameter(
+            parameter,
+            'Les entités existantes, du scénario si il est renseigné, qui ne sont plus produites par '
+            'l\'intersection sont supprimées.')
+        self.addParameter(parameter)
+
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.NUMBER_OF_REPAIRED,
+                'Nombre de géométries corrigées',
+            )
+        )
+
     def checkParameterValues(self, parameters, context):
         layers = [
             self.parameterAsVectorLayer(parameters, self.HABITAT_LAYER, context),
@@ -119,6 +169,11 @@ class BaseCalculHabitatImpactEtatEcologique(CalculAlgorithm):
             if not flag:
                 return False, msg
 
+        output_layer = layers[-1]
+        flag, msg = self.check_layer_has_no_pending_edits(output_layer)
+        if not flag:
+            return False, msg
+
         return super().checkParameterValues(parameters, context)
 
     def processAlgorithm(self, parameters, context, feedback):
@@ -127,161 +182,184 @@ class BaseCalculHabitatImpactEtatEcologique(CalculAlgorithm):
         self.output_layer = self.parameterAsVectorLayer(
             parameters, self.HABITAT_IMPACT_ETAT_ECOLOGIQUE_LAYER, context)
 
-        multi_feedback = QgsProcessingMultiStepFeedback(4, feedback)
+        multi_feedback = QgsProcessingMultiStepFeedback(2, feedback)
 
         multi_feedback.setCurrentStep(0)
         multi_feedback.pushInfo(
-            "Calcul de l'intersection entre les couches habitat et {}".format(self.project_type.label))
-        params = {
-            'INPUT': habitat,
-            'OVERLAY': impact,
-            'INPUT_FIELDS': [],  # All fields
-            'OVERLAY_FIELDS': ['id', 'scenario_id'],
-            'OVERLAY_FIELDS_PREFIX': '{}_'.format(self.project_type.label),
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-        }
-        results = processing.run(
-            "native:intersection",
-            params,
-            context=context,
-            feedback=multi_feedback,
-            is_child_algorithm=True,
-        )
-        intersection = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-
-        multi_feedback.pushInfo("Renommage des champs")
-        multi_feedback.setCurrentStep(1)
-        # Rename id to habitat_id
-        # Rename pression_scenario_id to scenario_id (or compensation_id)
-        index_habitat = intersection.fields().indexOf('id')
-        index_impact_id = intersection.fields().indexOf('{}_scenario_id'.format(self.project_type.label))
-
-        with edit(intersection):
-            intersection.renameAttribute(index_habitat, 'habitat_id')
-            intersection.renameAttribute(index_impact_id, 'scenario_id')
-
-        intersection.updateFields()
-
-        multi_feedback.pushInfo(
-            "Collect des géométries ayant les couples {} identiques".format(' ,'.join(self.fields_id)))
-        multi_feedback.setCurrentStep(2)
-        params = {
-            'INPUT': intersection,
-            'FIELD': list(self.fields_id),
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-        }
-        results = processing.run(
-            "native:collect",
-            params,
-            context=context,
-            feedback=multi_feedback,
-            is_child_algorithm=True,
-        )
+            "Calcul de l'intersection entre les couches habitat et {}, "
+            "regroupée par {}".format(self.project_type.label, ', '.join(self.fields_id)))
 
-        multi_feedback.pushInfo("Correction des géométries")
-        multi_feedback.setCurrentStep(3)
+        # Filtre sur le scénario, exécuté par le geopackage
+        impact_filter = None
+        if parameters.get(self.SCENARIO_ID) is not None:
+            scenario_id = self.parameterAsInt(parameters, self.SCENARIO_ID, context)
+            multi_feedback.pushInfo('Scénario {}'.format(scenario_id))
+            impact_filter = QgsExpression.createFieldEqualityExpression('scenario_id', scenario_id)
 
-        params = {
-            'INPUT': results['OUTPUT'],
-            'DISTANCE': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT',
-        }
-        results = processing.run(
-            "native:buffer",
-            params,
-            context=context,
-            feedback=multi_feedback,
-            is_child_algorithm=True)
+        fields, features = self.overlay_features(habitat, impact, context, multi_feedback, impact_filter)
 
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
+        # Type de pression de chaque pression, lu une seule fois
+        impact_types = self.impact_types(impact, impact_filter)
 
         multi_feedback.pushInfo("Import des entités dans la couche du geopackage")
-        multi_feedback.setCurrentStep(4)
-        field_map = {}
-        for i, field in enumerate(self.output_layer.fields()):
-            field_map[field.name()] = i
-
-        with edit(self.output_layer):
-            for feature in layer.getFeatures():
-                habitat_id = feature['habitat_id']
-                impact_id = feature[self.impact_id]
-                scenario_id = feature['scenario_id']
-
-                # Fixme, need to check for compensation this behavior
-                if self.impact_field:
-                    # Test du type de pression associé
-                    filter_expression = QgsExpression.createFieldEqualityExpression('id', impact_id)
-                    filter_request = QgsFeatureRequest(QgsExpression(filter_expression))
-                    filter_request.setLimit(1)
-                    for press in impact.getFeatures(filter_expression):
-                        pression_emprise = (press['type_pression'] == 6)
-                        break
-                else:
-                    pression_emprise = False
-
-                exists, existing_feature = self.feature_exists(
-                    self.output_layer, habitat_id, impact_id, scenario_id)
-
-                if exists:
-                    self.output_layer.changeGeometry(existing_feature.id(), feature.geometry())
+        multi_feedback.setCurrentStep(1)
+        delete_outdated = self.parameterAsBool(parameters, self.DELETE_OUTDATED, context)
+        self.upsert(fields, features, impact_types, impact_filter, delete_outdated, multi_feedback)
+        self.output_layer.reloadData()
 
-                    attribute_map = dict()
-                    for field in layer.fields():
-                        field_name = field.name()
-                        if field_name in self.fields_id:
-                            continue
+        return {self.NUMBER_OF_REPAIRED: self.number_of_repaired}
 
-                        if field_name in self.output_layer.fields().names():
-                            if pression_emprise and field_name in self.fields():
-                                attribute_map[field_map[field_name]] = 0
-                            else:
-                                attribute_map[field_map[field_name]] = feature[field_name]
+    def existing_features(self, scenario_filter=None) -> dict:
+        """ FID of the existing features by habitat, scenario and impact IDs, in a single query. """
+        provider = self.output_layer.dataProvider()
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(self.fields_id), provider.fields())
+        if scenario_filter:
+            request.setFilterExpression(scenario_filter)
+
+        existing = {}
+        for feature in provider.getFeatures(request):
+            existing[tuple(feature[field] for field in self.fields_id)] = feature.id()
+        return existing
+
+    def column_mapping(self, fields, output_fields) -> ColumnMapping:
+        """ Mapping of the overlay fields to the output fields, computed once. """
+        skip = frozenset(self.fields_id)
+        zeroed = frozenset(self.fields())
+        indexes = []
+        zero_indexes = set()
+        for i, field in enumerate(fields):
+            field_name = field.name()
+            if field_name in skip:
+                continue
+
+            index = output_fields.indexOf(field_name)
+            if index < 0:
+                continue
+
+            indexes.append((i, index))
+            if field_name in zeroed:
+                zero_indexes.add(index)
+
+        return ColumnMapping(tuple(indexes), frozenset(zero_indexes))
 
-                    self.output_layer.changeAttributeValues(existing_feature.id(), attribute_map)
+    @staticmethod
+    def output_attributes(feature, mapping: ColumnMapping, pression_emprise) -> dict:
+        """ Attributes to write in the output layer, by field index. """
+        attributes = feature.attributes()
+        if pression_emprise:
+            return {
+                index: 0 if index in mapping.zero_indexes else attributes[i] for i, index in mapping.indexes
+            }
+        return {index: attributes[i] for i, index in mapping.indexes}
+
+    def upsert(self, fields, features, impact_types, scenario_filter, delete_outdated, feedback) -> None:
+        """ Update the existing features, add the new ones and delete the outdated ones if asked. """
+        provider = self.output_layer.dataProvider()
+        output_fields = provider.fields()
+
+        # Les entités existantes, pour le scénario, sont lues en une seule requête
+        existing = self.existing_features(scenario_filter)
+        mapping = self.column_mapping(fields, output_fields)
+        # Surface enregistrée pour le calcul des pertes et gains, si le champ existe
+        surface_index = output_fields.indexOf(self.SURFACE)
+
+        for chunk in chunks(features, BATCH_SIZE):
+            if feedback.isCanceled():
+                return
+
+            geometries = {}
+            attributes = {}
+            new_features = []
+            for feature in chunk:
+                key = tuple(feature[field] for field in self.fields_id)
 
+                # Fixme, need to check for compensation this behavior
+                # Test du type de pression associé
+                pression_emprise = impact_types.get(key[2]) == 6
+
+                attribute_map = self.output_attributes(feature, mapping, pression_emprise)
+                if surface_index >= 0:
+                    attribute_map[surface_index] = feature.geometry().area()
+                fid = existing.pop(key, None)
+                if fid is not None:
+                    geometries[fid] = feature.geometry()
+                    attributes[fid] = attribute_map
                 else:
                     # We create a new feature
-                    out_feature = QgsFeature(self.output_layer.fields())
-                    out_feature.setAttribute('habitat_id', habitat_id)
-                    out_feature.setAttribute(self.impact_id, impact_id)
-                    out_feature.setAttribute('scenario_id', scenario_id)
+                    out_feature = QgsFeature(output_fields)
+                    for field, value in zip(self.fields_id, key):
+                        out_feature.setAttribute(field, value)
+                    for index, value in attribute_map.items():
+                        out_feature.setAttribute(index, value)
                     out_feature.setGeometry(feature.geometry())
+                    new_features.append(out_feature)
+
+            # Une seule transaction pour les modifications du lot, puis pour les ajouts
+            if attributes and not provider.changeFeatures(attributes, geometries):
+                raise QgsProcessingException(
+                    'Erreur lors de la mise à jour de la couche {} : {}'.format(
+                        self.output_layer.name(), ', '.join(provider.errors())))
+
+            if new_features:
+                result, _ = provider.addFeatures(new_features)
+                if not result:
+                    raise QgsProcessingException(
+                        'Erreur lors de l\'ajout dans la couche {} : {}'.format(
+                            self.output_layer.name(), ', '.join(provider.errors())))
+
+        if delete_outdated and existing:
+            feedback.pushInfo('Suppression de {} entité(s) qui ne sont plus dans l\'intersection'.format(
+                len(existing)))
+            if not provider.deleteFeatures(list(existing.values())):
+                raise QgsProcessingException(
+                    'Erreur lors de la suppression dans la couche {} : {}'.format(
+                        self.output_layer.name(), ', '.join(provider.errors())))
+
+    def impact_types(self, impact, impact_filter=None) -> dict:
+        """ Type of each impact by ID, empty if the impact has no type. """
+        if not self.impact_field:
+            return {}
 
-                    for field in layer.fields():
-                        field_name = field.name()
-                        if field_name in self.fields_id:
-                            continue
-
-                        if field_name in self.output_layer.fields().names():
-                            if pression_emprise and field_name in self.fields():
-                                out_feature.setAttribute(field_name, 0)
-                            else:
-                                out_feature.setAttribute(field_name, feature[field_name])
-
-                    self.output_layer.addFeature(out_feature)
-
-        return {}
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(['id', self.impact_field], impact.fields())
+        if impact_filter:
+            request.setFilterExpression(impact_filter)
+        return {feature['id']: feature[self.impact_field] for feature in impact.getFeatures(request)}
+
+    def overlay_features(
+            self, habitat, impact, context, feedback, impact_filter=None) -> Tuple[QgsFields, list]:
+        """ Features of the intersection between habitats and impacts, grouped by fields_id. """
+        # Champs de l'habitat, l'identifiant étant renommé habitat_id,
+        # puis l'identifiant et le scénario de la pression ou compensation
+        fields = QgsFields()
+        for field in habitat.fields():
+            field = QgsField(field)
+            if field.name() == 'id':
+                field.setName('habitat_id')
+            fields.append(field)
+        fields.append(QgsField(self.impact_id, QVariant.LongLong))
+        fields.append(QgsField('scenario_id', QVariant.LongLong))
+
+        features = []
+        repair = GeometryRepair()
+        groups = intersection_by_group(
+            habitat, impact, ['id', 'scenario_id'], context.transformContext(), feedback, impact_filter,
+            repair)
+        for habitat_feature, (impact_id, scenario_id), geometry in groups:
+            feature = QgsFeature(fields)
+            feature.setAttributes(habitat_feature.attributes() + [impact_id, scenario_id])
+            feature.setGeometry(geometry)
+            features.append(feature)
+
+        self.number_of_repaired = repair.count
+        return fields, features
 
     def postProcess(self, context, feedback):
         self.output_layer.triggerRepaint()
 
-    @staticmethod
-    def feature_exists(layer, habitat_id, pression_id, scenario_id) -> Tuple[bool, Optional[QgsFeature]]:
-        """ Check if the given feature exists. """
-        request = QgsFeatureRequest()
-        request.setLimit(1)
-        request.setFilterExpression(
-            '"habitat_id" = {habitat} AND "pression_id" = {pression} AND "scenario_id" = {scenario}'.format(
-                habitat=habitat_id,
-                pression=pression_id,
-                scenario=scenario_id,
-            ))
-        feature = QgsFeature()
-        if layer.getFeatures(request).nextFeature(feature):
-            return True, feature
-        else:
-            return False, None
-
 
 class CalculHabitatPressionEtatEcologique(BaseCalculHabitatImpactEtatEcologique):
 
@@ -6,36 +6,53 @@ from collections import OrderedDict
 
 from qgis.core import (
     QgsExpression,
+    QgsFeatureSink,
     QgsField,
     QgsMapLayerType,
     QgsProcessing,
+    QgsProcessingException,
     QgsProcessingFeatureBasedAlgorithm,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterEnum,
 )
 from qgis.PyQt.QtCore import QVariant
 from qgis.PyQt.QtGui import QIcon
 
+from mercicor.processing.calcul.notes_engine import (
+    INDICATORS,
+    NOTES,
+    compute_feature_notes,
+    note_dependencies,
+)
+from mercicor.processing.utils import BATCH_SIZE, chunks
 from mercicor.qgis_plugin_tools import resources_path
 
 
 class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
 
+    ENGINE = 'ENGINE'
+    ENGINE_COLUMNS = 0
+    ENGINE_EXPRESSIONS = 1
+
     def __init__(self):
         """
         Fonction d'initialisation
         """
         super().__init__()
+        # engine will be chosen in prepareAlgorithm
+        self.engine = self.ENGINE_COLUMNS
         # expression context will be created in prepareAlgorithm
         self.exp_context = None
+        # prepared expressions, keyed by note name and fields layout
+        self.prepared_expressions = {}
+        # fields layout and expressions used by processFeature
+        self.exp_fields = None
+        self.exp_notes = None
         # needed fields to calculate notes
-        self.fields = [
-            "perc_bsd", "perc_bsm", "bsd_recouv_cor", "bsd_p_acrop", "bsd_vital_cor",
-            "bsd_comp_struc", "bsd_taille_cor", "bsd_dens_juv", "bsd_f_sessile", "bsd_recouv_ma",
-            "bsm_fragm_herb", "bsm_recouv_her", "bsm_haut_herb", "bsm_dens_herb", "bsm_div_herb",
-            "bsm_epibiose", "man_fragm", "man_recouv", "man_diam_tronc", "man_dens", "man_diversit",
-            "man_vital", "pmi_div_poi", "pmi_predat_poi", "pmi_scarib_poi", "pmi_macro_inv"
-        ]
-
-        # note expressions
+        self.fields = list(INDICATORS)
+
+        # note expressions, used by the expressions engine
+        # the columns engine in notes_engine applies the same formulas
         self.expressions = OrderedDict()
         self.expressions['note_bsd'] = (
             '(("bsd_recouv_cor" + "bsd_p_acrop" + "bsd_vital_cor" + "bsd_comp_struc" + '
@@ -99,6 +116,10 @@ class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
         Description de l'algorithme
         """
         message = 'Calcul des notes MERCI-Cor à partir des indicateurs MERCI-Cor\n\n'
+        message += (
+            'Le moteur par colonnes calcule les notes par lots d\'objets. '
+            'Le moteur par expressions QGIS évalue les formules ci-dessous pour chaque objet.\n\n'
+        )
         message += 'Liste des notes :\n\n'
         for field, formula in self.expressions.items():
             message += '{} = {}\n\n'.format(field, formula)
@@ -155,7 +176,14 @@ class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
         """
         Fonction d'ajout des paramètres autres que la couche à modifier
         """
-        pass
+        parameter = QgsProcessingParameterEnum(
+            self.ENGINE,
+            'Moteur de calcul',
+            options=['Formules MERCI-Cor par colonnes', 'Expressions QGIS'],
+            defaultValue=self.ENGINE_COLUMNS,
+        )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter)
 
     def prepareAlgorithm(self, parameters, context, feedback):
         """
@@ -169,29 +197,70 @@ class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
         if not self.check_fields(source.fields()):
             return False
 
+        self.engine = self.parameterAsEnum(parameters, self.ENGINE, context)
+        if self.engine == self.ENGINE_COLUMNS:
+            return True
+
         # create expression context
         self.exp_context = self.createExpressionContext(parameters, context, source)
+
+        # compile expressions once for the source fields layout
+        self.prepared_expressions = {}
+        self.exp_fields = source.fields()
+        self.exp_notes = self.prepare_expressions(self.exp_fields, feedback)
         return True
 
+    def prepare_expressions(self, fields, feedback):
+        """
+        Préparation des expressions des notes pour une liste de champs
+
+        Les expressions préparées sont conservées par nom de note et par
+        structure de champs, pour n'être compilées qu'une seule fois.
+        """
+        layout = tuple(fields.names())
+        self.exp_context.setFields(fields)
+
+        expressions = OrderedDict()
+        for note, formula in self.expressions.items():
+            key = (note, layout)
+            if key not in self.prepared_expressions:
+                # création de l'expression
+                expression = QgsExpression(formula)
+                # préparation de l'expression
+                expression.prepare(self.exp_context)
+                if expression.hasParserError() or expression.hasEvalError():
+                    feedback.reportError(
+                        'Erreur lors de la préparation de l\'expression "{}": {}'.format(
+                            expression.expression(),
+                            expression.parserErrorString() or expression.evalErrorString()))
+                    expression = None
+                self.prepared_expressions[key] = expression
+
+            if self.prepared_expressions[key] is not None:
+                expressions[note] = self.prepared_expressions[key]
+
+        return expressions
+
     def processFeature(self, feature, context, feedback):
         """
         Fonction de modification des objets géographiques.
 
         Application des expressions pour les champs à mettre à jour
         """
-        # boucle sur les champs des notes merci-cor
-        for note in self.expressions.keys():
-            # création de l'expression
-            expression = QgsExpression(self.expressions[note])
-            # préparation de l'expression
-            expression.prepare(self.exp_context)
-            if expression.hasEvalError():
-                feedback.reportError(
-                    'Erreur lors de la préparation de l\'expression "{}": {}'.format(
-                        expression.expression(),
-                        expression.evalErrorString()))
-                continue
+        if self.engine == self.ENGINE_COLUMNS:
+            notes = compute_feature_notes([feature], feature.fields())
+            for note, values in notes.items():
+                feature[note] = values[0]
+            return [feature]
+
+        # les expressions sont déjà préparées, sauf si la structure des champs change
+        fields = feature.fields()
+        if fields != self.exp_fields:
+            self.exp_fields = fields
+            self.exp_notes = self.prepare_expressions(fields, feedback)
 
+        # boucle sur les champs des notes merci-cor
+        for note, expression in self.exp_notes.items():
             # Ajout de l'objet géographique au context de l'expression
             self.exp_context.setFeature(feature)
             # Evaluation de l'expression
@@ -205,6 +274,53 @@ class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
 
         return [feature]
 
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Fonction de calcul par lots d'objets avec le moteur par colonnes
+
+        Le moteur par expressions QGIS utilise le traitement objet par objet.
+        """
+        if self.engine == self.ENGINE_EXPRESSIONS:
+            return super().processAlgorithm(parameters, context, feedback)
+
+        source = self.parameterAsSource(parameters, 'INPUT', context)
+        source_fields = source.fields()
+        output_fields = self.outputFields(source.fields())
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, 'OUTPUT', context, output_fields, source.wkbType(), source.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, 'OUTPUT'))
+
+        # Les champs ajoutés par outputFields sont à la fin
+        # La recherche n'est pas sensible à la casse, comme dans check_fields et outputFields
+        note_indexes = [(note, output_fields.lookupField(note)) for note in NOTES]
+        missing_notes = [note for note, index in note_indexes if index < 0]
+        if missing_notes:
+            raise QgsProcessingException(
+                'Champ(s) manquant(s) pour les notes : {}'.format(', '.join(missing_notes)))
+        missing = [None] * (output_fields.count() - source_fields.count())
+
+        total = source.featureCount()
+        step = 100.0 / total if total > 0 else 1
+        current = 0
+        for features in chunks(source.getFeatures(), BATCH_SIZE):
+            if feedback.isCanceled():
+                break
+
+            notes = compute_feature_notes(features, source_fields)
+            for i, feature in enumerate(features):
+                attributes = feature.attributes() + missing
+                for note, index in note_indexes:
+                    attributes[index] = notes[note][i]
+                feature.setFields(output_fields, False)
+                feature.setAttributes(attributes)
+
+            sink.addFeatures(features, QgsFeatureSink.FastInsert)
+            current += len(features)
+            feedback.setProgress(current * step)
+
+        return {'OUTPUT': dest_id}
+
     def supportInPlaceEdit(self, layer):
         """
         Fonction de vérification que la couche est compatible avec l'algorithme
@@ -215,6 +331,12 @@ class CalculNotes(QgsProcessingFeatureBasedAlgorithm):
         # Vérification que la couche contient les champs nécessaires aux calculs des notes
         return self.check_fields(layer.fields())
 
+    def dependencies(self):
+        """
+        Champs utilisés par chaque note, y compris ceux des notes dont elle dépend
+        """
+        return note_dependencies(self.expressions)
+
     def check_fields(self, layer_fields):
         """
         Fonction de vérification que la couche contient les champs nécessaires
@@ -0,0 +1,219 @@
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsProcessing,
+    QgsProcessingException,
+    QgsProcessingOutputNumber,
+    QgsProcessingParameterDefinition,
+    QgsProcessingParameterField,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterString,
+    QgsProcessingParameterVectorLayer,
+    QgsVectorDataProvider,
+)
+
+from mercicor.processing.calcul.base import CalculAlgorithm
+from mercicor.processing.calcul.calcul_notes import CalculNotes
+from mercicor.processing.calcul.notes_engine import (
+    INDICATORS,
+    NOTES,
+    STATION_MAN,
+    affected_notes,
+    compute_feature_notes,
+)
+from mercicor.processing.utils import BATCH_SIZE as DEFAULT_BATCH_SIZE
+from mercicor.processing.utils import chunks
+
+
+class CalculNotesLayer(CalculAlgorithm):
+
+    INPUT = 'INPUT'
+    FEATURE_IDS = 'FEATURE_IDS'
+    CHANGED_FIELDS = 'CHANGED_FIELDS'
+    BATCH_SIZE = 'BATCH_SIZE'
+    NUMBER_OF_FEATURES = 'NUMBER_OF_FEATURES'
+
+    def __init__(self):
+        super().__init__()
+        self.layer = None
+
+    def name(self):
+        return 'calcul_notes_layer'
+
+    def displayName(self):
+        return 'Mise à jour des notes MERCI-Cor d\'une couche'
+
+    def shortHelpString(self):
+        return (
+            'Mise à jour des notes MERCI-Cor directement dans une couche du geopackage.\n\n'
+            'Les notes sont calculées par lots d\'objets et toutes les notes sont '
+            'enregistrées en une seule transaction dans le geopackage, à la fin du calcul.\n'
+            'Si l\'algorithme est annulé ou en cas d\'erreur, aucune note n\'est modifiée.\n'
+            'La couche ne doit pas avoir de modifications en cours.\n\n'
+            'Pour une mise à jour après quelques modifications, il est possible de '
+            'limiter le calcul aux objets modifiés et aux notes qui dépendent des '
+            'indicateurs modifiés.'
+        )
+
+    def initAlgorithm(self, config):
+        parameter = QgsProcessingParameterVectorLayer(
+            self.INPUT,
+            'Couche à mettre à jour',
+            [QgsProcessing.TypeVector],
+            defaultValue='observations',
+        )
+        self.set_tooltip_parameter(
+            parameter, 'Couche du geopackage comportant les indicateurs et les notes MERCI-Cor')
+        self.addParameter(parameter)
+
+        parameter = QgsProcessingParameterString(
+            self.FEATURE_IDS,
+            'Identifiants des objets modifiés',
+            optional=True,
+        )
+        self.set_tooltip_parameter(
+            parameter,
+            'Liste des identifiants des objets modifiés, séparés par une virgule. '
+            'Tous les objets sont mis à jour si la liste est vide.')
+        self.addParameter(parameter)
+
+        parameter = QgsProcessingParameterField(
+            self.CHANGED_FIELDS,
+            'Indicateurs modifiés',
+            None,
+            self.INPUT,
+            QgsProcessingParameterField.Any,
+            allowMultiple=True,
+            optional=True,
+        )
+        self.set_tooltip_parameter(
+            parameter,
+            'Seules les notes qui dépendent de ces indicateurs sont mises à jour. '
+            'Toutes les notes sont mises à jour si la liste est vide.')
+        self.addParameter(parameter)
+
+        parameter = QgsProcessingParameterNumber(
+            self.BATCH_SIZE,
+            'Nombre d\'objets par lot',
+            QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_BATCH_SIZE,
+            minValue=1,
+        )
+        parameter.setFlags(parameter.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.set_tooltip_parameter(
+            parameter, 'Nombre d\'objets lus et calculés ensemble')
+        self.addParameter(parameter)
+
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.NUMBER_OF_FEATURES,
+                'Nombre d\'objets mis à jour'
+            )
+        )
+
+    def checkParameterValues(self, parameters, context):
+        """
+        Check if the layer is in the geopackage, has the fields and no pending edits
+        """
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        flag, msg = self.check_layer_is_geopackage(layer)
+        if not flag:
+            return False, msg
+
+        layer_fields = layer.dataProvider().fields()
+        missing = [field for field in INDICATORS + NOTES if layer_fields.indexOf(field) < 0]
+        if missing:
+            return False, 'Les champs {} manquent'.format(', '.join(missing))
+
+        flag, msg = self.check_layer_has_no_pending_edits(layer)
+        if not flag:
+            return False, msg
+
+        try:
+            self.feature_ids(parameters, context)
+        except ValueError:
+            msg = 'Les identifiants des objets modifiés doivent être des entiers séparés par une virgule'
+            return False, msg
+
+        return super().checkParameterValues(parameters, context)
+
+    def feature_ids(self, parameters, context) -> list:
+        """ List of feature IDs to update, empty for all features. """
+        feature_ids = self.parameterAsString(parameters, self.FEATURE_IDS, context)
+        return [int(fid) for fid in feature_ids.split(',') if fid.strip()]
+
+    def processAlgorithm(self, parameters, context, feedback):
+        self.layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        batch_size = self.parameterAsInt(parameters, self.BATCH_SIZE, context)
+
+        # Lecture avec le provider, sans les jointures de la couche
+        provider = self.layer.dataProvider()
+        if not provider.capabilities() & QgsVectorDataProvider.ChangeAttributeValues:
+            raise QgsProcessingException(
+                'La couche {} ne peut pas être modifiée'.format(self.layer.name()))
+
+        # Notes à mettre à jour, selon les indicateurs modifiés
+        notes = NOTES
+        changed_fields = self.parameterAsFields(parameters, self.CHANGED_FIELDS, context)
+        if changed_fields:
+            notes = affected_notes(CalculNotes().dependencies(), changed_fields)
+            feedback.pushInfo('Notes à mettre à jour : {}'.format(', '.join(notes)))
+            if not notes:
+                return {self.NUMBER_OF_FEATURES: 0}
+
+        fields = provider.fields()
+        # Les champs du provider sont les premiers champs de la couche
+        note_indexes = [(note, fields.indexOf(note)) for note in notes]
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(list(INDICATORS) + [STATION_MAN], fields)
+
+        # Objets à mettre à jour
+        feature_ids = self.feature_ids(parameters, context)
+        if feature_ids:
+            request.setFilterFids(feature_ids)
+            total = len(feature_ids)
+        else:
+            total = provider.featureCount()
+        step = 100.0 / total if total > 0 else 1
+
+        # Les notes sont gardées dans le tampon d'édition et enregistrées ensemble à la fin
+        if not self.layer.isEditable() and not self.layer.startEditing():
+            raise QgsProcessingException('Impossible de modifier la couche {}'.format(self.layer.name()))
+
+        updated = 0
+        for features in chunks(provider.getFeatures(request), batch_size):
+            if feedback.isCanceled():
+                self.layer.rollBack()
+                feedback.pushInfo('Calcul annulé, aucune note n\'a été modifiée')
+                return {self.NUMBER_OF_FEATURES: 0}
+
+            values = compute_feature_notes(features, fields)
+            for i, feature in enumerate(features):
+                changes = {index: values[note][i] for note, index in note_indexes}
+                if not self.layer.changeAttributeValues(feature.id(), changes):
+                    self.layer.rollBack()
+                    raise QgsProcessingException(
+                        'Erreur lors de la modification des notes de l\'objet {}'.format(feature.id()))
+
+            updated += len(features)
+            feedback.setProgress(updated * step)
+
+        # Une seule transaction pour toutes les notes
+        if not self.layer.commitChanges():
+            errors = self.layer.commitErrors()
+            self.layer.rollBack()
+            raise QgsProcessingException(
+                'Erreur lors de l\'enregistrement des notes : {}'.format(', '.join(errors)))
+
+        feedback.pushInfo('{} objet(s) mis à jour'.format(updated))
+        return {self.NUMBER_OF_FEATURES: updated}
+
+    def postProcessAlgorithm(self, context, feedback):
+        self.layer.reloadData()
+        self.layer.triggerRepaint()
+        return {}
@@ -5,18 +5,22 @@ __email__ = "info@3liz.org"
 from collections import OrderedDict
 
 from qgis.core import (
-    QgsExpression,
+    QgsFeatureRequest,
     QgsProcessing,
+    QgsProcessingException,
     QgsProcessingParameterVectorLayer,
 )
-from qgis.PyQt.QtCore import NULL
 
 from mercicor.definitions.project_type import ProjectType
 from mercicor.processing.calcul.base import CalculAlgorithm
+from mercicor.processing.utils import is_null
 
 
 class BaseCalculPertesGains(CalculAlgorithm):
 
+    # Champ de la surface, enregistrée par le calcul de l'état écologique
+    SURFACE = 'surface'
+
     def __init__(self):
         super().__init__()
         self.fields = OrderedDict()
@@ -56,6 +60,11 @@ class BaseCalculPertesGains(CalculAlgorithm):
             if not flag:
                 return False, msg
 
+        scenario_impact = sources[0]
+        flag, msg = self.check_layer_has_no_pending_edits(scenario_impact)
+        if not flag:
+            return False, msg
+
         return super().checkParameterValues(parameters, context)
 
     def shortHelpString(self):
@@ -100,35 +109,84 @@ class BaseCalculPertesGains(CalculAlgorithm):
             parameters, self.HABITAT_IMPACT_ETAT_ECOLOGIQUE, context)
         scenario_impact = self.parameterAsVectorLayer(parameters, self.SCENARIO_IMPACT, context)
 
-        scenario_impact.startEditing()
-
-        for feat in scenario_impact.getFeatures():
-            scenario_id = feat['id']
-            for note in self.fields.keys():
-                # from "bsd" to "perte_bsd" or "gain_bsd"
-                field_name = '{calcul_type}_{note}'.format(
-                    calcul_type=self.project_type.calcul_type, note=note)
-                feat[field_name] = 0
-
-                filter_expression = QgsExpression.createFieldEqualityExpression('scenario_id', scenario_id)
-                for feature in hab_etat_ecolo.getFeatures(filter_expression):
-
-                    if feature[self.fields[note][1]] == NULL:
-                        feedback.pushDebugInfo(
-                            "Omission du calcul {} pour l'entité {}".format(field_name, feature.id()))
-                        continue
-
-                    if self.project_type == ProjectType.Pression:
-                        sub_result = feature[self.fields[note][0]] - feature[self.fields[note][1]]
-                    else:
-                        sub_result = feature[self.fields[note][1]] - feature[self.fields[note][0]]
-                    feat[field_name] += sub_result * feature.geometry().area()
-
-            scenario_impact.updateFeature(feat)
-        scenario_impact.commitChanges()
+        # from "bsd" to "perte_bsd" or "gain_bsd"
+        output_fields = OrderedDict()
+        for note in self.fields.keys():
+            output_fields[note] = '{calcul_type}_{note}'.format(
+                calcul_type=self.project_type.calcul_type, note=note)
+
+        # Somme de chaque note par scénario, en une seule lecture de la table
+        # La surface enregistrée est utilisée si elle existe, sans lire les géométries
+        has_surface = hab_etat_ecolo.fields().indexOf(self.SURFACE) >= 0
+        sums = {}
+        field_names = [field for formula in self.fields.values() for field in formula]
+        request = QgsFeatureRequest()
+        attributes = field_names + ['scenario_id']
+        if has_surface:
+            attributes.append(self.SURFACE)
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(attributes, hab_etat_ecolo.fields())
+
+        missing_surfaces = []
+        for feature in hab_etat_ecolo.getFeatures(request):
+            if feedback.isCanceled():
+                break
+
+            if not has_surface:
+                area = feature.geometry().area()
+            elif is_null(feature[self.SURFACE]):
+                missing_surfaces.append(feature.id())
+                continue
+            else:
+                area = feature[self.SURFACE]
+            self.add_feature(feature, area, sums, output_fields, feedback)
+
+        # Les entités enregistrées avant l'ajout de la surface
+        if missing_surfaces:
+            request.setFlags(QgsFeatureRequest.NoFlags)
+            request.setFilterFids(missing_surfaces)
+            for feature in hab_etat_ecolo.getFeatures(request):
+                self.add_feature(feature, feature.geometry().area(), sums, output_fields, feedback)
+
+        # Enregistrement des notes de tous les scénarios en une seule transaction
+        provider = scenario_impact.dataProvider()
+        fields = provider.fields()
+        indexes = OrderedDict()
+        for note, field_name in output_fields.items():
+            indexes[note] = fields.indexOf(field_name)
+
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(['id'], fields)
+        changes = {}
+        for feat in provider.getFeatures(request):
+            scenario_sums = sums.get(feat['id'], dict.fromkeys(self.fields.keys(), 0))
+            changes[feat.id()] = {index: scenario_sums[note] for note, index in indexes.items()}
+
+        if changes and not provider.changeAttributeValues(changes):
+            raise QgsProcessingException(
+                'Erreur lors de l\'enregistrement des notes : {}'.format(', '.join(provider.errors())))
+        scenario_impact.reloadData()
 
         return {}
 
+    def add_feature(self, feature, area, sums, output_fields, feedback) -> None:
+        """ Add the notes of the feature, multiplied by its area, to the sums of its scenario. """
+        scenario_sums = sums.setdefault(feature['scenario_id'], dict.fromkeys(self.fields.keys(), 0))
+        for note, formula in self.fields.items():
+            hab_value = feature[formula[0]]
+            value = feature[formula[1]]
+            if is_null(value) or is_null(hab_value):
+                feedback.pushDebugInfo(
+                    "Omission du calcul {} pour l'entité {}".format(output_fields[note], feature.id()))
+                continue
+
+            if self.project_type == ProjectType.Pression:
+                sub_result = hab_value - value
+            else:
+                sub_result = value - hab_value
+            scenario_sums[note] += sub_result * area
+
 
 class CalculPertes(BaseCalculPertesGains):
 
@@ -2,12 +2,16 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-import processing
+from collections import OrderedDict
 
 from qgis.core import (
     QgsCategorizedSymbolRenderer,
-    QgsExpression,
+    QgsFeature,
     QgsFeatureRequest,
+    QgsFeatureSink,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
     QgsPalLayerSettings,
     QgsProcessing,
     QgsProcessingLayerPostProcessorInterface,
@@ -21,8 +25,10 @@ from qgis.core import (
     QgsVectorLayerSimpleLabeling,
     QgsWkbTypes,
 )
+from qgis.PyQt.QtCore import QVariant
 
 from mercicor.processing.calcul.base import CalculAlgorithm
+from mercicor.processing.utils import is_null
 
 
 class SetLabelingPostProcessor(QgsProcessingLayerPostProcessorInterface):
@@ -89,6 +95,7 @@ class CalculUnicityHabitat(CalculAlgorithm):
 
     INPUT = 'INPUT'
     OUTPUT = 'OUTPUT'
+    OUTPUT_TABLE = 'OUTPUT_TABLE'
     NUMBER_OF_UNIQUE = 'NUMBER_OF_UNIQUE'
     NUMBER_OF_NON_UNIQUE = 'NUMBER_OF_NON_UNIQUE'
 
@@ -133,6 +140,16 @@ class CalculUnicityHabitat(CalculAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT_TABLE,
+                "Table des couples habitat/faciès non uniques",
+                QgsProcessing.TypeVector,
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
         self.addOutput(
             QgsProcessingOutputNumber(
                 self.NUMBER_OF_UNIQUE,
@@ -170,84 +187,41 @@ class CalculUnicityHabitat(CalculAlgorithm):
         request = QgsFeatureRequest()
         request.setFlags(QgsFeatureRequest.NoGeometry)
         request.setSubsetOfAttributes(self.fields, source.fields())
-        request.addOrderBy("|| ' - ' || ".join(self.fields))
 
-        unique_couples = []
-        non_unique_couples = []
+        # Identifiants des objets pour chaque couple nom/faciès
+        couples = OrderedDict()
         for src_feature in source.getFeatures(request):
-            couple = (
-                src_feature[self.fields[0]],
-                src_feature[self.fields[1]]
-            )
+            couple = tuple(
+                None if is_null(src_feature[field]) else src_feature[field] for field in self.fields)
+            couples.setdefault(couple, []).append(src_feature.id())
+
+        non_unique_couples = OrderedDict(
+            (couple, fids) for couple, fids in couples.items() if len(fids) > 1)
+
+        table_id = self.write_table(parameters, context, source, non_unique_couples)
 
-            if couple not in unique_couples:
-                unique_couples.append(couple)
-            else:
-                non_unique_couples.append(couple)
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.OUTPUT, context,
+            source.fields(), QgsWkbTypes.MultiPoint, source.sourceCrs())
 
         if not non_unique_couples:
             feedback.pushInfo('L\'ensemble des couples noms/faciès sont uniques')
-            (sink, dest_id) = self.parameterAsSink(
-                parameters, self.OUTPUT, context,
-                source.fields(), source.wkbType(), source.sourceCrs())
             return {
                 self.OUTPUT: dest_id,
-                self.NUMBER_OF_UNIQUE: len(unique_couples),
+                self.OUTPUT_TABLE: table_id,
+                self.NUMBER_OF_UNIQUE: len(couples),
                 self.NUMBER_OF_NON_UNIQUE: 0
             }
 
         feedback.pushInfo('Certains couples ne sont pas uniques :')
-        for couple in non_unique_couples:
-            feedback.pushInfo('   {} - {}'.format(couple[0], couple[1]))
-
-        expressions = []
-        for couple in non_unique_couples:
-            exp = ' AND '.join([
-                QgsExpression.createFieldEqualityExpression(self.fields[0], couple[0]),
-                QgsExpression.createFieldEqualityExpression(self.fields[1], couple[1])
-            ])
-            expressions.append(exp)
-        exp = '('
-        exp += ') OR ('.join(expressions)
-        exp += ')'
-        feedback.pushDebugInfo(exp)
-        exp_context = self.createExpressionContext(parameters, context, source)
+        for couple, fids in non_unique_couples.items():
+            feedback.pushInfo('   {} - {} : {} objets'.format(couple[0], couple[1], len(fids)))
 
-        request = QgsFeatureRequest()
-        request.setFilterExpression(exp)
-        request.setExpressionContext(exp_context)
-
-        layer = source.materialize(request)
+        if sink is not None:
+            self.write_points(sink, source, non_unique_couples, feedback)
 
-        params = {
-            'ALL_PARTS': True,
-            'INPUT': layer,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:pointonsurface",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'FIELD': self.fields,
-            'OUTPUT': parameters[self.OUTPUT]
-        }
-        results = processing.run(
-            "native:collect",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        output_layer = results['OUTPUT']
-        if context.willLoadLayerOnCompletion(output_layer):
-            layer_details = context.layerToLoadOnCompletionDetails(output_layer)
+        if context.willLoadLayerOnCompletion(dest_id):
+            layer_details = context.layerToLoadOnCompletionDetails(dest_id)
             output_def = self.parameterDefinition(self.OUTPUT)
             layer_details.name = output_def.description()
             layer_details.setPostProcessor(
@@ -255,7 +229,69 @@ class CalculUnicityHabitat(CalculAlgorithm):
             )
 
         return {
-            self.OUTPUT: output_layer,
-            self.NUMBER_OF_UNIQUE: len(unique_couples),
+            self.OUTPUT: dest_id,
+            self.OUTPUT_TABLE: table_id,
+            self.NUMBER_OF_UNIQUE: len(couples),
             self.NUMBER_OF_NON_UNIQUE: len(non_unique_couples)
         }
+
+    @staticmethod
+    def write_points(sink, source, non_unique_couples, feedback):
+        """ Write a multipoint for each non unique couple, with a point on surface for each part. """
+        couple_of_fid = {fid: couple for couple, fids in non_unique_couples.items() for fid in fids}
+
+        # Seuls les objets des couples non uniques, déjà connus, sont lus
+        request = QgsFeatureRequest()
+        request.setFilterFids(list(couple_of_fid.keys()))
+
+        # Les attributs sont ceux du premier objet de chaque couple
+        features = {}
+        points = {}
+        for src_feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                break
+
+            couple = couple_of_fid[src_feature.id()]
+            if couple not in features:
+                features[couple] = QgsFeature(src_feature)
+                points[couple] = []
+
+            geometry = src_feature.geometry()
+            if geometry.isNull():
+                continue
+
+            for part in geometry.asGeometryCollection():
+                point = part.pointOnSurface()
+                if not point.isNull():
+                    points[couple].append(point)
+
+        output_features = []
+        for couple in non_unique_couples.keys():
+            if couple not in features:
+                continue
+            feature = features[couple]
+            feature.setGeometry(QgsGeometry.collectGeometry(points[couple]))
+            output_features.append(feature)
+
+        sink.addFeatures(output_features, QgsFeatureSink.FastInsert)
+
+    def write_table(self, parameters, context, source, non_unique_couples):
+        """ Write each non unique couple with its number of features and their IDs. """
+        fields = QgsFields()
+        for field in self.fields:
+            fields.append(source.fields().field(field))
+        fields.append(QgsField('nombre', QVariant.Int))
+        fields.append(QgsField('ids', QVariant.String))
+
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.OUTPUT_TABLE, context, fields, QgsWkbTypes.NoGeometry)
+        if sink is None:
+            return None
+
+        features = []
+        for couple, fids in non_unique_couples.items():
+            feature = QgsFeature(fields)
+            feature.setAttributes(list(couple) + [len(fids), ', '.join([str(fid) for fid in fids])])
+            features.append(feature)
+        sink.addFeatures(features, QgsFeatureSink.FastInsert)
+        return dest_id
@@ -0,0 +1,155 @@
+"""Column based engine for the MERCI-Cor notes.
+
+Same formulas as the QGIS expressions in CalculNotes, evaluated on columns
+of values instead of one expression per feature. A NULL indicator gives a
+NULL note, like in a QGIS expression.
+"""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from collections import OrderedDict
+from typing import Iterable, List
+
+from qgis.core import QgsExpression, QgsFields, QgsProcessingException
+
+from mercicor.processing.utils import is_null
+
+BSD_FIELDS = (
+    "bsd_recouv_cor", "bsd_p_acrop", "bsd_vital_cor", "bsd_comp_struc",
+    "bsd_taille_cor", "bsd_dens_juv", "bsd_f_sessile", "bsd_recouv_ma",
+)
+BSM_FIELDS = (
+    "bsm_fragm_herb", "bsm_recouv_her", "bsm_haut_herb", "bsm_dens_herb", "bsm_div_herb", "bsm_epibiose",
+)
+MAN_FIELDS = (
+    "man_fragm", "man_recouv", "man_diam_tronc", "man_dens", "man_diversit", "man_vital",
+)
+PMI_FIELDS = (
+    "pmi_div_poi", "pmi_predat_poi", "pmi_scarib_poi", "pmi_macro_inv",
+)
+
+# Needed fields to calculate notes
+INDICATORS = ("perc_bsd", "perc_bsm") + BSD_FIELDS + BSM_FIELDS + MAN_FIELDS + PMI_FIELDS
+
+# Optional field, the station is in the mangrove
+STATION_MAN = "station_man"
+
+NOTES = ("note_bsd", "note_bsm", "note_ben", "note_man", "note_pmi", "score_mercicor")
+
+
+def read_columns(features: Iterable, fields: QgsFields) -> dict:
+    """ Read the indicator columns from the features, in a single pass.
+
+    The field names are not case sensitive. A missing station field gives a column of NULL.
+    """
+    indexes = OrderedDict()
+    for field in INDICATORS + (STATION_MAN,):
+        indexes[field] = fields.lookupField(field)
+
+    missing = [field for field in INDICATORS if indexes[field] < 0]
+    if missing:
+        raise QgsProcessingException(
+            'Champ(s) manquant(s) pour le calcul des notes : {}'.format(', '.join(missing)))
+
+    columns = OrderedDict([(field, []) for field in indexes.keys()])
+    for feature in features:
+        attributes = feature.attributes()
+        for field, index in indexes.items():
+            columns[field].append(attributes[index] if index >= 0 else None)
+
+    return columns
+
+
+def _numbers(column: list) -> list:
+    """ Cast a column to float, None for NULL values. """
+    return [None if is_null(value) else float(value) for value in column]
+
+
+def _mean_note(columns: dict, fields: tuple) -> list:
+    """ Mean of the indicators, on 10. """
+    count = float(len(fields))
+    notes = []
+    for values in zip(*[columns[field] for field in fields]):
+        if None in values:
+            notes.append(None)
+        else:
+            notes.append((sum(values) / count) * (10.0 / 3.0))
+    return notes
+
+
+def _note_ben(note_bsd, note_bsm, perc_bsd, perc_bsm):
+    """ Benthic note, from the hard and soft substrates notes. """
+    if note_bsd is None:
+        return note_bsm
+    if note_bsm is None:
+        return note_bsd
+    if perc_bsd is None or perc_bsm is None:
+        return None
+    return note_bsd * perc_bsd + note_bsm * perc_bsm
+
+
+def _score_mercicor(station_man, note_man, note_ben, note_pmi):
+    """ MERCI-Cor score, from the mangrove or the benthic note. """
+    if not is_null(station_man) and str(station_man).lower() == 'true':
+        note = note_man
+    else:
+        note = note_ben
+
+    if note is None or note_pmi is None:
+        return None
+    return (note + note_pmi) / 2
+
+
+def compute_notes(columns: dict) -> OrderedDict:
+    """ Compute all notes from the indicator columns.
+
+    :param columns: Indicator columns, as returned by read_columns.
+    :return: Columns of notes, None for a NULL note, in the NOTES order.
+    """
+    values = {field: _numbers(columns[field]) for field in INDICATORS}
+
+    notes = OrderedDict()
+    notes['note_bsd'] = _mean_note(values, BSD_FIELDS)
+    notes['note_bsm'] = _mean_note(values, BSM_FIELDS)
+    notes['note_ben'] = [
+        _note_ben(*row) for row in zip(
+            notes['note_bsd'], notes['note_bsm'], values['perc_bsd'], values['perc_bsm'])
+    ]
+    notes['note_man'] = _mean_note(values, MAN_FIELDS)
+    notes['note_pmi'] = _mean_note(values, PMI_FIELDS)
+    notes['score_mercicor'] = [
+        _score_mercicor(*row) for row in zip(
+            columns[STATION_MAN], notes['note_man'], notes['note_ben'], notes['note_pmi'])
+    ]
+    return notes
+
+
+def compute_feature_notes(features: List, fields: QgsFields) -> OrderedDict:
+    """ Compute all notes for a list of features. """
+    return compute_notes(read_columns(features, fields))
+
+
+def note_dependencies(expressions: dict) -> OrderedDict:
+    """ Fields read by each note, including the fields read by the notes it uses.
+
+    :param expressions: QGIS expressions of the notes, in the computation order.
+    :return: Set of fields for each note.
+    """
+    dependencies = OrderedDict()
+    for note, formula in expressions.items():
+        fields = set()
+        for column in QgsExpression(formula).referencedColumns():
+            if column in dependencies:
+                fields.update(dependencies[column])
+            else:
+                fields.add(column)
+        dependencies[note] = fields
+    return dependencies
+
+
+def affected_notes(dependencies: dict, changed_fields: Iterable) -> list:
+    """ Notes to compute again when some fields have changed. """
+    changed_fields = set(changed_fields)
+    return [note for note, fields in dependencies.items() if fields & changed_fields]
@@ -0,0 +1,133 @@
+"""Cache of the habitat/facies unicity verdict, for the QGIS session.
+
+The verdict is kept in memory with a change token of the habitat table, read
+from the metadata of the geopackage: the date of the last change in
+gpkg_contents and the number of features in gpkg_ogr_contents. Reading the
+token does not read the features, and nothing is written in the geopackage.
+"""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+import sqlite3
+
+from pathlib import Path
+from typing import Optional
+
+import processing
+
+from qgis.core import QgsProviderRegistry, QgsVectorLayer
+
+# Verdict and token by habitat table
+_VERDICTS = {}
+
+
+def geopackage_path(layer: QgsVectorLayer) -> Optional[str]:
+    """ Path of the geopackage of the layer, None if it is not a geopackage layer. """
+    if layer.providerType() != 'ogr':
+        return None
+
+    uri = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+    if not uri['path'].lower().endswith('.gpkg'):
+        return None
+    return uri['path']
+
+
+def cache_key(layer: QgsVectorLayer) -> Optional[tuple]:
+    """ Key of the habitat table in the cache, with the filter of the layer if any. """
+    path = geopackage_path(layer)
+    if not path:
+        return None
+
+    uri = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+    if not uri.get('layerName'):
+        return None
+    return str(Path(path).resolve()), uri['layerName'], layer.subsetString()
+
+
+def change_token(layer: QgsVectorLayer) -> Optional[tuple]:
+    """ Change token of the habitat table, from the metadata of the geopackage.
+
+    :return: The date of the last change and the number of features, None if not available.
+    """
+    key = cache_key(layer)
+    if not key or layer.isModified():
+        return None
+
+    path, table, _ = key
+    try:
+        # Lecture seule, le geopackage n'est pas modifié
+        connection = sqlite3.connect('{}?mode=ro'.format(Path(path).as_uri()), uri=True)
+    except sqlite3.Error:
+        return None
+
+    try:
+        row = connection.execute(
+            'SELECT c.last_change, o.feature_count '
+            'FROM gpkg_contents AS c '
+            'JOIN gpkg_ogr_contents AS o ON lower(o.table_name) = lower(c.table_name) '
+            'WHERE lower(c.table_name) = lower(?)',
+            (table, )).fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        connection.close()
+
+    if not row or row[0] is None or row[1] is None:
+        return None
+    return row[0], row[1]
+
+
+def read_verdict(layer: QgsVectorLayer, token: tuple) -> Optional[dict]:
+    """ Cached result of the unicity check, None if not cached for this token. """
+    if token is None:
+        return None
+
+    cached = _VERDICTS.get(cache_key(layer))
+    if not cached or cached[0] != token:
+        return None
+    return dict(cached[1])
+
+
+def write_verdict(layer: QgsVectorLayer, token: tuple, results: dict) -> bool:
+    """ Keep the result of the unicity check for this token. """
+    if token is None:
+        return False
+
+    _VERDICTS[cache_key(layer)] = (token, {
+        'NUMBER_OF_UNIQUE': results['NUMBER_OF_UNIQUE'],
+        'NUMBER_OF_NON_UNIQUE': results['NUMBER_OF_NON_UNIQUE'],
+    })
+    return True
+
+
+def check_unicity(layer: QgsVectorLayer, context, feedback) -> dict:
+    """ Result of the unicity check, from the cache if the habitat layer has not changed.
+
+    :return: The NUMBER_OF_UNIQUE and NUMBER_OF_NON_UNIQUE outputs of the unicity algorithm.
+    """
+    token = change_token(layer)
+    results = read_verdict(layer, token)
+    if results is not None:
+        feedback.pushInfo(
+            'La couche habitat n\'a pas changé depuis la dernière vérification de l\'unicité '
+            'des couples habitat/faciès.')
+        return results
+
+    params = {
+        'INPUT': layer,
+        'OUTPUT': 'TEMPORARY_OUTPUT'
+    }
+    results = processing.run(
+        "mercicor:calcul_unicity_habitat",
+        params,
+        context=context,
+        feedback=feedback,
+        is_child_algorithm=True)
+
+    if not feedback.isCanceled():
+        if not write_verdict(layer, token, results):
+            feedback.pushDebugInfo('Le résultat de la vérification de l\'unicité n\'a pas été conservé')
+
+    return results
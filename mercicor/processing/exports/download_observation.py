@@ -18,15 +18,14 @@ from qgis.core import (
     QgsProcessingParameterBoolean,
     QgsProcessingParameterFileDestination,
     QgsProcessingParameterVectorLayer,
-    QgsProcessingUtils,
     QgsVectorFileWriter,
     QgsVectorLayer,
     edit,
 )
-from qgis.processing import run
 from qgis.PyQt.QtCore import QVariant
 
 from mercicor.processing.exports.base import BaseExportAlgorithm
+from mercicor.processing.spatial_join import PointIndex
 
 
 class DownloadObservationFile(BaseExportAlgorithm):
@@ -188,23 +187,33 @@ class DownloadObservationFile(BaseExportAlgorithm):
         """ Add information from the habitat layer into the export. """
         feedback.pushInfo('\n')
         feedback.pushInfo("Jointure spatiale avec la couche 'habitat' pour le champ 'facies'")
-        params = {
-            'INPUT': input_layer,
-            'JOIN': habitat_layer,
-            'PREDICATE': [0],  # Intersects
-            'JOIN_FIELDS': ['nom', 'facies'],
-            'METHOD': 1,  # Take attributes of the first located feature only (one-to-one)
-            'DISCARD_NONMATCHING': False,
-            'PREFIX': 'habitat_',
-            'OUTPUT':  'TEMPORARY_OUTPUT'
-        }
-        results = run(
-            'qgis:joinattributesbylocation',
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-        feedback.pushInfo('{} habitats ont été trouvés'.format(results['JOINED_COUNT']))
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
+        join_fields = ['nom', 'facies']
+
+        # Copie de la couche avec les champs de l'habitat
+        layer = input_layer.materialize(QgsFeatureRequest())
+        layer.setName(input_layer.name())
+        fields = []
+        for field_name in join_fields:
+            field = QgsField(habitat_layer.fields().field(field_name))
+            field.setName('habitat_{}'.format(field_name))
+            fields.append(field)
+        provider = layer.dataProvider()
+        provider.addAttributes(fields)
+        layer.updateFields()
+        indexes = [layer.fields().indexOf(field.name()) for field in fields]
+
+        # Premier habitat trouvé pour chaque observation
+        index = PointIndex(layer, habitat_layer.crs(), context.transformContext(), feedback=feedback)
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(join_fields, habitat_layer.fields())
+        changes = {}
+        for habitat, fids in index.matches(habitat_layer.getFeatures(request), feedback):
+            values = {
+                field_index: habitat[field_name] for field_index, field_name in zip(indexes, join_fields)
+            }
+            for fid in fids:
+                changes.setdefault(fid, values)
+        provider.changeAttributeValues(changes)
+
+        feedback.pushInfo('{} habitats ont été trouvés'.format(len(changes)))
         return layer
@@ -0,0 +1,64 @@
+"""Tools for the polygon geometries."""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from typing import List, Tuple
+
+from qgis.core import QgsGeometry, QgsWkbTypes
+
+
+def polygon_part(geometry: QgsGeometry) -> QgsGeometry:
+    """ Polygons of an intersection, without the points and lines of a geometry collection. """
+    if geometry.isNull() or geometry.isEmpty():
+        return QgsGeometry()
+
+    if geometry.type() == QgsWkbTypes.PolygonGeometry:
+        return geometry
+
+    parts = [
+        part for part in geometry.asGeometryCollection() if part.type() == QgsWkbTypes.PolygonGeometry
+    ]
+    if not parts:
+        return QgsGeometry()
+    return QgsGeometry.collectGeometry(parts)
+
+
+def repair_geometry(geometry: QgsGeometry) -> Tuple[QgsGeometry, bool]:
+    """ Repair the polygon only if it is not valid.
+
+    :return: The valid polygon, empty if nothing remains, and if it has been repaired.
+    """
+    if geometry.isNull() or geometry.isGeosValid():
+        return geometry, False
+
+    repaired = polygon_part(geometry.makeValid())
+    if repaired.isNull():
+        # Dernier recours si makeValid ne retourne pas de polygone
+        repaired = polygon_part(geometry.buffer(0, 5))
+    return repaired, True
+
+
+class GeometryRepair:
+
+    """ Repair of the invalid polygons, counting the repaired ones. """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, geometry: QgsGeometry) -> QgsGeometry:
+        geometry, repaired = repair_geometry(geometry)
+        if repaired:
+            self.count += 1
+        return geometry
+
+
+def union_polygons(geometries: List[QgsGeometry]) -> QgsGeometry:
+    """ Union of valid polygons, as a multi polygon. """
+    if len(geometries) == 1:
+        geometry = QgsGeometry(geometries[0])
+    else:
+        geometry = polygon_part(QgsGeometry.unaryUnion(geometries))
+    geometry.convertToMultiType()
+    return geometry
@@ -3,12 +3,32 @@ __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
 from abc import abstractmethod
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Tuple
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCoordinateTransformContext,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProcessingException,
+    QgsVectorLayer,
+)
 
 from mercicor.processing.base_algorithm import BaseProcessingAlgorithm
+from mercicor.processing.geometry import GeometryRepair, union_polygons
+from mercicor.processing.utils import BATCH_SIZE, chunks
 
 
 class BaseImportAlgorithm(BaseProcessingAlgorithm):
 
+    NUMBER_OF_REPAIRED = 'NUMBER_OF_REPAIRED'
+
+    def __init__(self):
+        super().__init__()
+        self.number_of_repaired = 0
+
     def group(self):
         return 'Import'
 
@@ -16,14 +36,115 @@ class BaseImportAlgorithm(BaseProcessingAlgorithm):
         return 'import'
 
     def checkParameterValues(self, parameters, context):
-        """ Check if all given output layers are in the geopackage. """
+        """ Check if all given output layers are in the geopackage, without pending edits. """
         destination = self.parameterAsVectorLayer(parameters, self.OUTPUT_LAYER, context)
         flag, msg = self.check_layer_is_geopackage(destination)
         if not flag:
             return False, msg
 
+        # Les modifications de l'utilisateur ne doivent pas être enregistrées ou annulées avec l'import
+        flag, msg = self.check_layer_has_no_pending_edits(destination)
+        if not flag:
+            return False, msg
+
         return super().checkParameterValues(parameters, context)
 
     @abstractmethod
     def shortHelpString(self):
         pass
+
+    @classmethod
+    def add_features(cls, layer: QgsVectorLayer, features: Iterable, total: int, feedback) -> int:
+        """ Add the features by chunks, saved in a single transaction.
+
+        Nothing is saved if the algorithm is canceled.
+
+        :return: The number of added features.
+        """
+        if not layer.isEditable() and not layer.startEditing():
+            raise QgsProcessingException('Impossible de modifier la couche {}'.format(layer.name()))
+
+        step = 100.0 / total if total > 0 else 1
+        added = 0
+        for chunk in chunks(features, BATCH_SIZE):
+            if feedback.isCanceled():
+                layer.rollBack()
+                return 0
+
+            if not layer.addFeatures(chunk):
+                layer.rollBack()
+                raise QgsProcessingException(
+                    'Erreur lors de l\'ajout des entités dans la couche {}'.format(layer.name()))
+
+            added += len(chunk)
+            feedback.setProgress(added * step)
+
+        cls.commit_changes(layer)
+        return added
+
+    @staticmethod
+    def commit_changes(layer: QgsVectorLayer):
+        """ Save the edits of the layer, in a single transaction. """
+        if not layer.commitChanges():
+            errors = layer.commitErrors()
+            layer.rollBack()
+            raise QgsProcessingException(
+                'Erreur lors de l\'enregistrement de la couche {} : {}'.format(
+                    layer.name(), ', '.join(errors)))
+
+    def normalize_features(
+            self,
+            source: QgsVectorLayer,
+            key_fields: List[str],
+            crs: QgsCoordinateReferenceSystem,
+            transform_context: QgsCoordinateTransformContext,
+            feedback) -> Iterator[Tuple[tuple, QgsGeometry]]:
+        """ Repair, group by key fields, promote to multi and reproject the geometries.
+
+        Same result as the buffer of 0, collect, promote to multi, reproject and buffer
+        of 0 algorithms, in a single pass without temporary layers. Only the invalid
+        geometries are repaired, the number of repaired geometries is stored in
+        number_of_repaired.
+
+        :return: For each key, in the order of the source, its values and its multi geometry.
+        """
+        transform = None
+        if source.crs() != crs:
+            feedback.pushInfo(
+                'Le CRS de la couche de destination est différent. Reprojection en {}…'.format(crs.authid()))
+            # Une seule transformation pour toutes les géométries
+            transform = QgsCoordinateTransform(source.crs(), crs, transform_context)
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(key_fields, source.fields())
+
+        repair = GeometryRepair()
+        groups = OrderedDict()
+        for feature in source.getFeatures(request):
+            if feedback.isCanceled():
+                break
+
+            if not feature.hasGeometry():
+                continue
+
+            geometry = repair(feature.geometry())
+            if geometry.isNull() or geometry.isEmpty():
+                continue
+
+            key = tuple(feature[field] for field in key_fields)
+            groups.setdefault(key, []).append(geometry)
+
+        for key, geometries in groups.items():
+            geometry = union_polygons(geometries)
+            if transform:
+                geometry.transform(transform)
+                # La reprojection peut rendre la géométrie invalide
+                geometry = repair(geometry)
+                if geometry.isEmpty():
+                    continue
+                geometry.convertToMultiType()
+            yield key, geometry
+
+        self.number_of_repaired = repair.count
+        if repair.count:
+            feedback.pushInfo('{} géométrie(s) corrigée(s)'.format(repair.count))
@@ -2,17 +2,13 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-import processing
-
 from qgis.core import (
     QgsCategorizedSymbolRenderer,
     QgsFeature,
-    QgsFeatureRequest,
-    QgsGeometry,
     QgsProcessing,
+    QgsProcessingOutputNumber,
     QgsProcessingParameterField,
     QgsProcessingParameterVectorLayer,
-    QgsProcessingUtils,
     QgsRandomColorRamp,
     QgsRendererCategory,
     QgsSymbol,
@@ -89,98 +85,41 @@ class ImportHabitatData(BaseImportAlgorithm):
             )
         )
 
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.NUMBER_OF_REPAIRED,
+                'Nombre de géométries corrigées',
+            )
+        )
+
     def processAlgorithm(self, parameters, context, feedback):
         input_layer = self.parameterAsVectorLayer(parameters, self.INPUT_LAYER, context)
         facies_field = self.parameterAsExpression(parameters, self.FACIES_FIELD, context)
         name_field = self.parameterAsExpression(parameters, self.NAME_FIELD, context)
         self._output_layer = self.parameterAsVectorLayer(parameters, self.OUTPUT_LAYER, context)
 
-        params = {
-            'INPUT': input_layer,
-            'DISTANCE': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:buffer",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'FIELD': [name_field, facies_field],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:collect",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
+        groups = self.normalize_features(
+            input_layer,
+            [name_field, facies_field],
+            self.output_layer.crs(),
+            context.transformContext(),
+            feedback,
         )
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:promotetomulti",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        if input_layer.crs() != self.output_layer.crs():
-            feedback.pushInfo(
-                'Le CRS de la couche de destination est différent. Reprojection en {}…'.format(
-                    self.output_layer.crs().authid()))
-
-            params = {
-                'INPUT': results['OUTPUT'],
-                'TARGET_CRS': self.output_layer.crs(),
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }
-            results = processing.run(
-                "native:reprojectlayer",
-                params,
-                context=context,
-                feedback=feedback,
-                is_child_algorithm=True)
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'DISTANCE': 0,
-            'OUTPUT': 'memory:'
-        }
-        results = processing.run(
-            "native:buffer",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
-
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-
-        self.output_layer.startEditing()
-        request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([name_field, facies_field], input_layer.fields())
-        for input_feature in layer.getFeatures(request):
-
-            if feedback.isCanceled():
-                break
-
-            output_feature = QgsFeature(self.output_layer.fields())
-            geometry = QgsGeometry(input_feature.geometry())
-            output_feature.setGeometry(geometry)
-            output_feature.setAttribute('nom', input_feature[name_field])
-            output_feature.setAttribute('facies', input_feature[facies_field])
-            self.output_layer.addFeature(output_feature)
-
-        self.output_layer.commitChanges()
+        output_fields = self.output_layer.fields()
+
+        def output_features():
+            for (name, facies), geometry in groups:
+                output_feature = QgsFeature(output_fields)
+                output_feature.setGeometry(geometry)
+                output_feature.setAttribute('nom', name)
+                output_feature.setAttribute('facies', facies)
+                yield output_feature
+
+        # Une seule transaction pour l'ensemble des entités
+        added = self.add_features(self.output_layer, output_features(), input_layer.featureCount(), feedback)
+        feedback.pushInfo('{} entité(s) importée(s)'.format(added))
         self.set_style()
-        return {}
+        return {self.NUMBER_OF_REPAIRED: self.number_of_repaired}
 
     def set_style(self):
         """ Set the categorized style using random color. """
@@ -2,7 +2,8 @@ __copyright__ = "Copyright 2021, 3Liz"
 __license__ = "GPL version 3"
 __email__ = "info@3liz.org"
 
-from typing import Optional, Tuple
+from collections import OrderedDict
+from typing import Dict, List
 
 from qgis.core import (
     QgsCoordinateReferenceSystem,
@@ -10,25 +11,30 @@ from qgis.core import (
     QgsFeature,
     QgsFeatureRequest,
     QgsGeometry,
+    QgsPointXY,
     QgsProcessing,
+    QgsProcessingException,
+    QgsProcessingOutputString,
     QgsProcessingParameterVectorLayer,
-    edit,
 )
 
+from mercicor.definitions.data_models import field_names
 from mercicor.processing.imports.base import BaseImportAlgorithm
-from mercicor.qgis_plugin_tools import load_csv, resources_path
+from mercicor.processing.utils import BATCH_SIZE, chunks, is_null
 
 
 class ImportObservationData(BaseImportAlgorithm):
 
     INPUT_LAYER = 'INPUT_LAYER'
     OUTPUT_LAYER = 'OUTPUT_LAYER'
+    OBSERVATION_IDS = 'OBSERVATION_IDS'
 
     def __init__(self):
         super().__init__()
         self.input_fields = None
         self.fields = None
         self.output = None
+        self.transform = None
 
     def name(self):
         return 'import_donnees_observation'
@@ -62,6 +68,13 @@ class ImportObservationData(BaseImportAlgorithm):
             )
         )
 
+        self.addOutput(
+            QgsProcessingOutputString(
+                self.OBSERVATION_IDS,
+                'Identifiants des observations importées'
+            )
+        )
+
     def processAlgorithm(self, parameters, context, feedback):
         input_layer = self.parameterAsVectorLayer(parameters, self.INPUT_LAYER, context)
         self.output = self.parameterAsVectorLayer(parameters, self.OUTPUT_LAYER, context)
@@ -74,24 +87,93 @@ class ImportObservationData(BaseImportAlgorithm):
             feedback.pushInfo('Les champs latitude et longitude ne sont pas détectés.')
 
         # Observation fields
-        path = resources_path('data_models', 'observations.csv')
-        csv = load_csv('observations', path)
-        self.fields = list(csv.uniqueValues(1))
+        self.fields = list(field_names('observations'))
         self.fields.append('latitude')
         self.fields.append('longitude')
 
-        for feature in input_layer.getFeatures():
-            exists, existing = self.observation_exists(self.output, feature['id'])
-            if exists:
-                self.update_feature(feature, existing, has_geom, context, feedback)
+        # Une seule transformation pour toutes les observations
+        self.transform = QgsCoordinateTransform(
+            QgsCoordinateReferenceSystem('EPSG:4326'), self.output.crs(), context.transformContext())
+
+        observation_ids = self.import_features(input_layer, has_geom, feedback)
+
+        # Pour la mise à jour de l'état écologique des seuls habitats de ces observations
+        return {self.OBSERVATION_IDS: ','.join([str(fid) for fid in observation_ids])}
+
+    def import_features(self, input_layer, with_geom, feedback) -> List[int]:
+        """ Update or create the observations, saved in a single transaction.
+
+        Rows with the same ID are merged, each row without ID is a new observation.
+
+        :return: The FIDs of the updated and created observations, empty if the algorithm is canceled.
+        """
+        # Les identifiants existants sont lus une seule fois
+        existing = self.existing_observations(self.output)
+        output_fields = self.output.fields()
+        # Nouvelles observations, et celles ayant un identifiant pour fusionner les doublons
+        new_features = []
+        new_features_by_id = {}
+        updated_fids = OrderedDict()
+
+        # Les modifications en attente sont refusées par checkParameterValues
+        if not self.output.isEditable() and not self.output.startEditing():
+            raise QgsProcessingException('Impossible de modifier la couche {}'.format(self.output.name()))
+
+        total = input_layer.featureCount()
+        step = 100.0 / total if total > 0 else 1
+        for i, feature in enumerate(input_layer.getFeatures()):
+            if feedback.isCanceled():
+                self.output.rollBack()
+                return []
+
+            observation_id = feature['id']
+            if is_null(observation_id) or observation_id == '':
+                output_feature = QgsFeature(output_fields)
+                self.create_feature(feature, output_feature, with_geom, feedback)
+                # L'identifiant sera attribué par le geopackage
+                output_feature.setAttribute('id', None)
+                new_features.append(output_feature)
+            elif observation_id in existing:
+                fid = existing[observation_id]
+                self.update_feature(feature, fid, with_geom, feedback)
+                updated_fids[fid] = True
             else:
-                self.create_feature(feature, has_geom, context, feedback)
-
-        return {}
-
-    def update_feature(self, feature, existing, with_geom, context, feedback):
-        """ Update the existing observation in the geopackage. """
-
+                # Un même identifiant présent plusieurs fois met à jour la nouvelle observation
+                output_feature = new_features_by_id.get(observation_id)
+                if output_feature is None:
+                    output_feature = QgsFeature(output_fields)
+                    new_features_by_id[observation_id] = output_feature
+                    new_features.append(output_feature)
+                self.create_feature(feature, output_feature, with_geom, feedback)
+
+            feedback.setProgress(i * step)
+
+        for chunk in chunks(new_features, BATCH_SIZE):
+            if not self.output.addFeatures(chunk):
+                self.output.rollBack()
+                raise QgsProcessingException(
+                    'Erreur lors de l\'ajout des observations dans la couche {}'.format(self.output.name()))
+
+        # Les FID des nouvelles observations sont connus à l'enregistrement
+        added_fids = []
+
+        def features_added(_layer_id, features):
+            added_fids.extend(feature.id() for feature in features)
+
+        self.output.committedFeaturesAdded.connect(features_added)
+        try:
+            self.commit_changes(self.output)
+        finally:
+            self.output.committedFeaturesAdded.disconnect(features_added)
+
+        feedback.pushInfo(
+            '{} observation(s) mise(s) à jour, {} observation(s) créée(s)'.format(
+                len(updated_fids), len(added_fids)))
+        return list(updated_fids.keys()) + added_fids
+
+    def update_feature(self, feature, fid, with_geom, feedback):
+        """ Update the existing observation, in the edit buffer of the layer. """
+        fields = self.output.fields()
         attributes = dict()
         latitude = None
         longitude = None
@@ -103,20 +185,18 @@ class ImportObservationData(BaseImportAlgorithm):
                 if with_geom:
                     longitude = feature['longitude']
             elif field in self.input_fields:
-                attributes[existing.fields().indexOf(field)] = feature[field]
+                attributes[fields.indexOf(field)] = feature[field]
             else:
                 feedback.pushDebugInfo('Omission du champ {}'.format(field))
 
-        with edit(self.output):
-            feedback.pushInfo('Mise à jour de l\'observation {}'.format(feature['nom_station']))
-            self.output.changeAttributeValues(existing.id(), attributes)
-            if latitude and longitude:
-                geom = self.create_point(longitude, latitude, self.output.crs(), context)
-                self.output.changeGeometry(existing.id(), geom)
+        feedback.pushDebugInfo('Mise à jour de l\'observation {}'.format(feature['nom_station']))
+        self.output.changeAttributeValues(fid, attributes)
+        if latitude and longitude:
+            geom = self.create_point(longitude, latitude, self.transform)
+            self.output.changeGeometry(fid, geom)
 
-    def create_feature(self, feature, with_geom, context, feedback):
-        """ Create the new observation and import it in the geopackage. """
-        output_feature = QgsFeature(self.output.fields())
+    def create_feature(self, feature, output_feature, with_geom, feedback):
+        """ Fill the new observation, added later in the geopackage. """
         latitude = None
         longitude = None
         for field in self.fields:
@@ -132,38 +212,24 @@ class ImportObservationData(BaseImportAlgorithm):
                 feedback.pushDebugInfo('Omission du champ {}'.format(field))
 
         if latitude and longitude:
-            geom = self.create_point(longitude, latitude, self.output.crs(), context)
+            geom = self.create_point(longitude, latitude, self.transform)
             output_feature.setGeometry(geom)
 
-        with edit(self.output):
-            feedback.pushInfo('Création de la nouvelle observation {}'.format(feature['nom_station']))
-            self.output.addFeature(output_feature)
+        feedback.pushDebugInfo('Création de la nouvelle observation {}'.format(feature['nom_station']))
 
     @staticmethod
-    def create_point(
-            longitude: int, latitude: int, crs: QgsCoordinateReferenceSystem, context) -> QgsGeometry:
+    def create_point(longitude: float, latitude: float, transform: QgsCoordinateTransform) -> QgsGeometry:
         """ Create the point geometry and reproject it. """
-        geom = QgsGeometry.fromWkt('POINT({} {})'.format(longitude, latitude))
-
-        transform = QgsCoordinateTransform(
-            QgsCoordinateReferenceSystem('EPSG:4326'),
-            crs,
-            context.project())
-        geom.transform(transform)
-        return geom
+        point = transform.transform(QgsPointXY(float(longitude), float(latitude)))
+        return QgsGeometry.fromPointXY(point)
 
     @staticmethod
-    def observation_exists(layer, feature_id) -> Tuple[bool, Optional[QgsFeature]]:
-        """ Check if the given observation exists. """
+    def existing_observations(layer) -> Dict[int, int]:
+        """ FID of each existing observation, from its ID, in a single request. """
         request = QgsFeatureRequest()
-        request.setLimit(1)
+        request.setFlags(QgsFeatureRequest.NoGeometry)
         request.setSubsetOfAttributes(['id'], layer.fields())
-        request.setFilterExpression('"id" = {}'.format(feature_id))
-        join_feature = QgsFeature()
-        if layer.getFeatures(request).nextFeature(join_feature):
-            return True, join_feature
-        else:
-            return False, None
+        return {feature['id']: feature.id() for feature in layer.getFeatures(request)}
 
     def postProcess(self, context, feedback):
         self.output_layer.reloadData()
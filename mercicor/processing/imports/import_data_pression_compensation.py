@@ -9,17 +9,18 @@ from qgis.core import (
     QgsFeatureRequest,
     QgsProcessing,
     QgsProcessingException,
+    QgsProcessingOutputNumber,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterField,
     QgsProcessingParameterString,
     QgsProcessingParameterVectorLayer,
-    QgsProcessingUtils,
     QgsVectorLayer,
     edit,
 )
 from qgis.PyQt.QtCore import NULL
 
 from mercicor.definitions.project_type import ProjectType
+from mercicor.processing.calcul.unicity_cache import check_unicity
 from mercicor.processing.imports.base import BaseImportAlgorithm
 
 
@@ -150,6 +151,13 @@ class BaseImportImpactData(BaseImportAlgorithm):
             )
         )
 
+        self.addOutput(
+            QgsProcessingOutputNumber(
+                self.NUMBER_OF_REPAIRED,
+                'Nombre de géométries corrigées',
+            )
+        )
+
     def checkParameterValues(self, parameters, context):
         layers = [
             self.parameterAsVectorLayer(parameters, self.SCENARIO_LAYER, context),
@@ -193,89 +201,41 @@ class BaseImportImpactData(BaseImportAlgorithm):
                 )
             )
 
-        params = {
-            'INPUT': input_layer,
-            'DISTANCE': 0,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:buffer",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'FIELD': [impact_field],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:collect",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True,
-        )
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "native:promotetomulti",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
-
-        if input_layer.crs() != self.output_layer.crs():
-            feedback.pushInfo(
-                'Le CRS de la couche de destination est différent. Reprojection en {}…'.format(
-                    self.output_layer.crs().authid()))
-
-            params = {
-                'INPUT': results['OUTPUT'],
-                'TARGET_CRS': self.output_layer.crs(),
-                'OUTPUT': 'TEMPORARY_OUTPUT'
-            }
-            results = processing.run(
-                "native:reprojectlayer",
-                params,
-                context=context,
-                feedback=feedback,
-                is_child_algorithm=True)
-
-        params = {
-            'INPUT': results['OUTPUT'],
-            'DISTANCE': 0,
-            'OUTPUT': 'memory:'
-        }
-        results = processing.run(
-            "native:buffer",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
-
-        layer = QgsProcessingUtils.mapLayerFromString(results['OUTPUT'], context, True)
-
         self.scenario_id = self.insert_scenario(scenario_layer, scenario_name)
         feedback.pushInfo('Création du scénario numéro {} : {}'.format(self.scenario_id, scenario_name))
 
-        request = QgsFeatureRequest()
-        request.setSubsetOfAttributes([impact_field], input_layer.fields())
-        for input_feature in layer.getFeatures(request):
-
-            if feedback.isCanceled():
-                break
-
-            output_feature = QgsFeature(self.output_layer.fields())
-            output_feature.setGeometry(input_feature.geometry())
-            output_feature.setAttribute('scenario_id', self.scenario_id)
-            output_feature.setAttribute(self.destination_impact_field, input_feature[impact_field])
-            with edit(self.output_layer):
-                self.output_layer.addFeature(output_feature)
+        groups = self.normalize_features(
+            input_layer,
+            [impact_field],
+            self.output_layer.crs(),
+            context.transformContext(),
+            feedback,
+        )
+        output_fields = self.output_layer.fields()
+
+        def output_features():
+            for (impact_value, ), geometry in groups:
+                output_feature = QgsFeature(output_fields)
+                output_feature.setGeometry(geometry)
+                output_feature.setAttribute('scenario_id', self.scenario_id)
+                output_feature.setAttribute(self.destination_impact_field, impact_value)
+                yield output_feature
+
+        # Une seule transaction pour l'ensemble des entités
+        try:
+            added = self.add_features(self.output_layer, output_features(), len(unique_values), feedback)
+        except QgsProcessingException:
+            self.delete_scenario(scenario_layer, self.scenario_id)
+            raise
+
+        # Rien n'a été importé, le scénario est supprimé et le calcul n'est pas lancé
+        if feedback.isCanceled():
+            self.delete_scenario(scenario_layer, self.scenario_id)
+            feedback.pushInfo('Import annulé, suppression du scénario numéro {}'.format(self.scenario_id))
+            return {self.NUMBER_OF_REPAIRED: self.number_of_repaired}
+
+        feedback.pushInfo('{} entité(s) importée(s)'.format(added))
+        outputs = {self.NUMBER_OF_REPAIRED: self.number_of_repaired}
 
         if not self.output_layer.setSubsetString('"scenario_id" = {}'.format(self.scenario_id)):
             raise QgsProcessingException('Subset string is not valid')
@@ -286,22 +246,14 @@ class BaseImportImpactData(BaseImportAlgorithm):
         # Si apply_calcul = False
         # Alors l'algo s'arrête ici
         if not apply_calcul:
-            return {}
+            return outputs
 
         habitat = self.parameterAsVectorLayer(parameters, self.HABITAT_LAYER, context)
         habitat_impact = self.parameterAsVectorLayer(parameters, self.HABITAT_IMPACT_LAYER, context)
 
         # Vérification de l'unicité des couples habitat/faciès
-        params = {
-            'INPUT': habitat,
-            'OUTPUT': 'TEMPORARY_OUTPUT'
-        }
-        results = processing.run(
-            "mercicor:calcul_unicity_habitat",
-            params,
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True)
+        # Le résultat est réutilisé si la couche habitat n'a pas changé
+        results = check_unicity(habitat, context, feedback)
 
         # Si les couple habitat/faciès ne sont pas unique
         # Alors le calcul ne se fait pas
@@ -312,14 +264,15 @@ class BaseImportImpactData(BaseImportAlgorithm):
             msg = (
                 'Utiliser l\'algorithme Mercicor "Calcul unicité habitat/faciès" pour corriger le problème.')
             feedback.pushInfo(msg)
-            return {}
+            return outputs
 
         params = {
             'HABITAT_LAYER': habitat,
             '{}_LAYER'.format(self.project_type.label.upper()): self.output_layer,
-            'HABITAT_{}_ETAT_ECOLOGIQUE_LAYER'.format(self.project_type.label.upper()): habitat_impact
+            'HABITAT_{}_ETAT_ECOLOGIQUE_LAYER'.format(self.project_type.label.upper()): habitat_impact,
+            'SCENARIO_ID': self.scenario_id,
         }
-        processing.run(
+        results = processing.run(
             "mercicor:calcul_habitat_{}_etat_ecologique".format(self.project_type.label),
             params,
             context=context,
@@ -327,7 +280,9 @@ class BaseImportImpactData(BaseImportAlgorithm):
             is_child_algorithm=True,
         )
 
-        return {}
+        # Géométries corrigées lors de l'import et lors de l'intersection avec les habitats
+        outputs[self.NUMBER_OF_REPAIRED] += results[self.NUMBER_OF_REPAIRED]
+        return outputs
 
     @staticmethod
     def insert_scenario(layer: QgsVectorLayer, name: str) -> int:
@@ -344,6 +299,16 @@ class BaseImportImpactData(BaseImportAlgorithm):
         layer.getFeatures(request).nextFeature(feature)
         return feature['id']
 
+    @staticmethod
+    def delete_scenario(layer: QgsVectorLayer, scenario_id: int):
+        """ Delete the scenario, when nothing has been imported for it. """
+        request = QgsFeatureRequest()
+        request.setFilterExpression('"id" = {}'.format(scenario_id))
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setNoAttributes()
+        with edit(layer):
+            layer.deleteFeatures([feature.id() for feature in layer.getFeatures(request)])
+
     def postProcess(self, context, feedback):
         self.output_layer.reloadData()
         self.output_layer.triggerRepaint()
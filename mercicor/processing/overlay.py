@@ -0,0 +1,131 @@
+"""Overlay of the habitats with the pressions or compensations."""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from collections import OrderedDict
+from typing import Iterator, List, Tuple
+
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeatureSource,
+    QgsGeometry,
+    QgsProcessingFeedback,
+    QgsRectangle,
+    QgsSpatialIndex,
+)
+
+from mercicor.processing.geometry import (
+    GeometryRepair,
+    polygon_part,
+    union_polygons,
+)
+
+
+def _read_impacts(
+        habitat: QgsFeatureSource,
+        impact: QgsFeatureSource,
+        impact_fields: List[str],
+        transform_context: QgsCoordinateTransformContext,
+        repair: GeometryRepair,
+        impact_filter: str = None) -> Tuple[List[Tuple[tuple, QgsGeometry]], QgsRectangle]:
+    """ Values and valid geometries of the impacts, in the CRS of the habitat layer, with their extent. """
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes(impact_fields, impact.fields())
+    request.setDestinationCrs(habitat.sourceCrs(), transform_context)
+    if impact_filter:
+        request.setFilterExpression(impact_filter)
+
+    impacts = []
+    extent = QgsRectangle()
+    extent.setMinimal()
+    for impact_feature in impact.getFeatures(request):
+        if not impact_feature.hasGeometry():
+            continue
+
+        geometry = repair(impact_feature.geometry())
+        if geometry.isNull():
+            continue
+
+        impacts.append((tuple(impact_feature[field] for field in impact_fields), geometry))
+        extent.combineExtentWith(geometry.boundingBox())
+
+    return impacts, extent
+
+
+def intersection_by_group(
+        habitat: QgsFeatureSource,
+        impact: QgsFeatureSource,
+        impact_fields: List[str],
+        transform_context: QgsCoordinateTransformContext,
+        feedback: QgsProcessingFeedback = None,
+        impact_filter: str = None,
+        repair: GeometryRepair = None) -> Iterator[Tuple[QgsFeature, tuple, QgsGeometry]]:
+    """ Intersection of the habitats with the impacts, grouped by habitat and impact fields.
+
+    The habitats in the extent of the impacts are stored in a spatial index, then
+    each impact is prepared and intersected with its candidate habitats. The parts
+    of a group are merged, in the CRS of the habitat layer. Only the invalid
+    geometries are repaired.
+
+    :param impact_filter: Expression to filter the impacts, like a scenario.
+    :param repair: Repair of the geometries, given to read the number of repaired geometries.
+    :return: For each group, the habitat feature, the values of the impact fields and the geometry.
+    """
+    if repair is None:
+        repair = GeometryRepair()
+    impacts, extent = _read_impacts(habitat, impact, impact_fields, transform_context, repair, impact_filter)
+    if not impacts:
+        return
+
+    # Seuls les habitats dans l'emprise des impacts sont indexés
+    request = QgsFeatureRequest()
+    request.setNoAttributes()
+    request.setFilterRect(extent)
+    index = QgsSpatialIndex(
+        habitat.getFeatures(request), feedback, QgsSpatialIndex.FlagStoreFeatureGeometries)
+
+    # Géométries des habitats, corrigées une seule fois si besoin
+    habitat_geometries = {}
+
+    parts = OrderedDict()
+    step = 100.0 / len(impacts)
+    for i, (values, geometry) in enumerate(impacts):
+        if feedback:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(i * step)
+
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+
+        for fid in index.intersects(geometry.boundingBox()):
+            if fid not in habitat_geometries:
+                habitat_geometries[fid] = repair(index.geometry(fid))
+            habitat_geometry = habitat_geometries[fid]
+            if habitat_geometry.isNull() or not engine.intersects(habitat_geometry.constGet()):
+                continue
+
+            intersection = polygon_part(geometry.intersection(habitat_geometry))
+            if intersection.isNull():
+                continue
+
+            parts.setdefault((fid, values), []).append(intersection)
+
+    if feedback and repair.count:
+        feedback.pushInfo('{} géométrie(s) corrigée(s)'.format(repair.count))
+
+    if not parts:
+        return
+
+    # Seuls les habitats ayant une intersection sont lus avec leurs attributs
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setFilterFids(list({fid for fid, _ in parts.keys()}))
+    habitats = {feature.id(): feature for feature in habitat.getFeatures(request)}
+
+    for (fid, values), geometries in parts.items():
+        yield habitats[fid], values, union_polygons(geometries)
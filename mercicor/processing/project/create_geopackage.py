@@ -23,10 +23,10 @@ from qgis.core import (
     edit,
 )
 
+from mercicor.definitions.data_models import data_model
 from mercicor.definitions.project_type import ProjectType
 from mercicor.definitions.tables import tables
 from mercicor.processing.project.base import BaseProjectAlgorithm
-from mercicor.qgis_plugin_tools import load_csv, resources_path
 
 
 class BaseCreateGeopackageProject(BaseProjectAlgorithm):
@@ -190,17 +190,12 @@ class BaseCreateGeopackageProject(BaseProjectAlgorithm):
 
             fields = QgsFields()
 
-            path = resources_path('data_models', '{}.csv'.format(table))
-            csv = load_csv(table, path)
-
-            for csv_feature in csv.getFeatures():
-                field = QgsField(name=csv_feature['name'], type=int(csv_feature['type']))
-                field.setComment(csv_feature['comment'])
-                field.setAlias(csv_feature['alias'])
+            for model_field in data_model(table):
+                field = QgsField(name=model_field.name, type=model_field.field_type)
+                field.setComment(model_field.comment)
+                field.setAlias(model_field.alias)
                 fields.append(field)
 
-            del csv
-
             # add fields
             data_provider.addAttributes(fields)
             vector_layer.updateFields()
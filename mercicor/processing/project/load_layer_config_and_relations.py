@@ -19,6 +19,7 @@ from qgis.core import (
 from qgis.PyQt.QtCore import QDir, QTemporaryFile
 
 from mercicor.actions import actions_list_compensation, actions_list_pression
+from mercicor.definitions.data_models import data_model
 from mercicor.definitions.joins import (
     attribute_joins_compensation,
     attribute_joins_pression,
@@ -29,7 +30,7 @@ from mercicor.definitions.relations import (
     relations_pression,
 )
 from mercicor.processing.project.base import BaseProjectAlgorithm
-from mercicor.qgis_plugin_tools import load_csv, resources_path
+from mercicor.qgis_plugin_tools import resources_path
 
 
 class BaseLoadLayerConfigAndRelations(BaseProjectAlgorithm):
@@ -273,15 +274,12 @@ class BaseLoadLayerConfigAndRelations(BaseProjectAlgorithm):
 
         for name, layer in input_layers.items():
             feedback.pushInfo("   {}".format(name))
-            path = resources_path('data_models', '{}.csv'.format(name))
-            csv = load_csv(name, path)
-
-            for csv_feature in csv.getFeatures():
-                index = layer.fields().indexOf(csv_feature['name'])
+            for model_field in data_model(name):
+                index = layer.fields().indexOf(model_field.name)
                 if not index:
                     continue
 
-                layer.setFieldAlias(index, csv_feature['alias'])
+                layer.setFieldAlias(index, model_field.alias)
 
     def add_styles(self, feedback, input_layers):
         """ Add all QML style in the resource folder to given layers. """
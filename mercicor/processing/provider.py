@@ -13,6 +13,7 @@ from mercicor.processing.calcul.calcul_habitat_impact_ecologique import (
     CalculHabitatPressionEtatEcologique,
 )
 from mercicor.processing.calcul.calcul_notes import CalculNotes
+from mercicor.processing.calcul.calcul_notes_layer import CalculNotesLayer
 from mercicor.processing.calcul.calcul_pertes_gains import (
     CalculGains,
     CalculPertes,
@@ -50,6 +51,7 @@ class MercicorProvider(QgsProcessingProvider):
         self.addAlgorithm(CalculHabitatEtatEcologique())
         self.addAlgorithm(CalculHabitatPressionEtatEcologique())
         self.addAlgorithm(CalculNotes())
+        self.addAlgorithm(CalculNotesLayer())
         self.addAlgorithm(CalculUnicityHabitat())
         self.addAlgorithm(CalculPertes())
         self.addAlgorithm(CreateGeopackageProjectCompensation())
@@ -0,0 +1,106 @@
+"""Point in polygon join, for the habitat/observations spatial join."""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from collections import OrderedDict
+from typing import Iterable, Iterator, List, Tuple
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransformContext,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsFeatureSource,
+    QgsGeometry,
+    QgsProcessingFeedback,
+    QgsRectangle,
+    QgsSpatialIndex,
+)
+
+
+class PointIndex:
+
+    """ Spatial index of the points of a layer.
+
+    The points are read once, in the CRS of the polygons, and each polygon is
+    prepared before testing its candidate points.
+    """
+
+    def __init__(
+            self,
+            source: QgsFeatureSource,
+            crs: QgsCoordinateReferenceSystem,
+            transform_context: QgsCoordinateTransformContext,
+            attributes: list = None,
+            feedback: QgsProcessingFeedback = None,
+            extent: QgsRectangle = None):
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(attributes if attributes else [], source.fields())
+        request.setDestinationCrs(crs, transform_context)
+        if extent is not None:
+            # Emprise dans le CRS des polygones
+            request.setFilterRect(extent)
+
+        self.index = QgsSpatialIndex()
+        self.features = {}
+        for feature in source.getFeatures(request):
+            if feedback and feedback.isCanceled():
+                break
+
+            if not feature.hasGeometry():
+                continue
+
+            self.index.addFeature(feature)
+            self.features[feature.id()] = feature
+
+    def feature(self, fid: int) -> QgsFeature:
+        """ Point feature from its ID. """
+        return self.features[fid]
+
+    def points_in(self, geometry: QgsGeometry) -> List[int]:
+        """ IDs of the points intersecting the polygon. """
+        if geometry.isNull():
+            return []
+
+        candidates = self.index.intersects(geometry.boundingBox())
+        if not candidates:
+            return []
+
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+        return [
+            fid for fid in candidates if engine.intersects(self.features[fid].geometry().constGet())
+        ]
+
+    def matches(
+            self,
+            polygons: Iterable[QgsFeature],
+            feedback: QgsProcessingFeedback = None) -> Iterator[Tuple[QgsFeature, List[int]]]:
+        """ Each polygon feature with the IDs of its points. """
+        for polygon in polygons:
+            if feedback and feedback.isCanceled():
+                break
+
+            yield polygon, self.points_in(polygon.geometry())
+
+    def join(self, polygons: Iterable[QgsFeature], feedback: QgsProcessingFeedback = None) -> OrderedDict:
+        """ IDs of the points of each polygon, for the polygons having points. """
+        result = OrderedDict()
+        for polygon, fids in self.matches(polygons, feedback):
+            if fids:
+                result[polygon.id()] = fids
+        return result
+
+
+def habitat_observations(
+        habitat: QgsFeatureSource,
+        observations: QgsFeatureSource,
+        transform_context: QgsCoordinateTransformContext,
+        feedback: QgsProcessingFeedback = None) -> OrderedDict:
+    """ IDs of the observations in each habitat, as in definitions.joins.spatial_joins. """
+    index = PointIndex(observations, habitat.sourceCrs(), transform_context, feedback=feedback)
+    request = QgsFeatureRequest()
+    request.setNoAttributes()
+    return index.join(habitat.getFeatures(request), feedback)
@@ -0,0 +1,28 @@
+"""Tools for processing algorithms."""
+
+__copyright__ = "Copyright 2021, 3Liz"
+__license__ = "GPL version 3"
+__email__ = "info@3liz.org"
+
+from itertools import islice
+from typing import Iterable, Iterator, List
+
+from qgis.PyQt.QtCore import NULL
+
+# Nombre d'entités lues ou enregistrées ensemble, dans une même transaction
+BATCH_SIZE = 1000
+
+
+def is_null(value) -> bool:
+    """ Check if the value is NULL. """
+    return value is None or value == NULL
+
+
+def chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """ Split an iterable, like a feature iterator, into lists of the given size. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,6 +1,12 @@
 """ Test calcul. """
 
+import csv
 import os
+import sqlite3
+
+from unittest import mock
+
+import processing
 
 from qgis.core import (
     QgsExpression,
@@ -10,18 +16,34 @@ from qgis.core import (
     QgsFeatureRequest,
     QgsField,
     QgsGeometry,
+    QgsPointXY,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingFeedback,
     QgsVectorLayer,
     QgsVectorLayerJoinInfo,
     edit,
 )
 from qgis.processing import run
-from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtCore import NULL, QVariant
 
+from mercicor.definitions.project_type import ProjectType
+from mercicor.processing.calcul import unicity_cache
+from mercicor.processing.calcul.calcul_habitat_etat_ecologique import (
+    CalculHabitatEtatEcologique,
+)
 from mercicor.processing.calcul.calcul_habitat_impact_ecologique import (
     BaseCalculHabitatImpactEtatEcologique,
 )
 from mercicor.processing.calcul.calcul_notes import CalculNotes
 from mercicor.processing.calcul.calcul_pertes_gains import CalculPertes
+from mercicor.processing.calcul.notes_engine import affected_notes
+from mercicor.processing.calcul.unicity_cache import (
+    change_token,
+    check_unicity,
+    read_verdict,
+)
+from mercicor.processing.spatial_join import habitat_observations
 from mercicor.qgis_plugin_tools import plugin_test_data_path
 from mercicor.tests.base_processing import BaseTestProcessing
 
@@ -32,6 +54,30 @@ __email__ = "info@3liz.org"
 
 class TestCalculsAlgorithms(BaseTestProcessing):
 
+    @staticmethod
+    def _observation_layer() -> QgsVectorLayer:
+        """ Internal function to get the observation layer filled with the CSV test data. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        layer = QgsVectorLayer('{}|layername=observations'.format(gpkg), 'observations', 'ogr')
+
+        with open(plugin_test_data_path('observations.csv'), encoding='utf8') as csv_file:
+            rows = list(csv.DictReader(csv_file))
+
+        with edit(layer):
+            for row in rows:
+                feature = QgsFeature(layer.fields())
+                feature.setAttribute('id', int(row['id']))
+                feature.setAttribute('nom_station', row['nom_station'])
+                feature.setAttribute('station_man', row['station_man'] == '1')
+                for field in CalculNotes().fields:
+                    if row[field]:
+                        feature.setAttribute(field, float(row[field]))
+                feature.setGeometry(
+                    QgsGeometry.fromPointXY(QgsPointXY(float(row['longitude']), float(row['latitude']))))
+                layer.addFeature(feature)
+
+        return layer
+
     def test_expressions_mercicor(self):
         """ Test that expressions are valid. """
         gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
@@ -54,6 +100,250 @@ class TestCalculsAlgorithms(BaseTestProcessing):
                 expression.prepare(context)
                 self.assertFalse(expression.hasParserError())
 
+    def test_calcul_notes(self):
+        """ Test the computation of the notes on the observations. """
+        layer = self._observation_layer()
+        self.assertEqual(8, layer.featureCount())
+
+        results = run("mercicor:calcul_notes", {'INPUT': layer, 'OUTPUT': 'TEMPORARY_OUTPUT'})
+        output = results['OUTPUT']
+        self.assertEqual(8, output.featureCount())
+
+        features = {feature['nom_station']: feature for feature in output.getFeatures()}
+
+        # Benthique de substrats durs uniquement
+        self.assertAlmostEqual(20 / 3, features['BSD1']['note_bsd'])
+        self.assertTrue(features['BSD1']['note_bsm'] is None or features['BSD1']['note_bsm'] == NULL)
+        self.assertAlmostEqual(20 / 3, features['BSD1']['note_ben'])
+        self.assertAlmostEqual(5, features['BSD1']['note_pmi'])
+        self.assertAlmostEqual((20 / 3 + 5) / 2, features['BSD1']['score_mercicor'])
+
+        # Benthique mixte
+        self.assertAlmostEqual(7.5, features['BEN1']['note_ben'])
+        self.assertAlmostEqual(6.25, features['BEN1']['score_mercicor'])
+
+        # Station en mangrove
+        self.assertAlmostEqual(10 / 3, features['MAN1']['note_man'])
+        self.assertAlmostEqual((10 / 3 + 5) / 2, features['MAN1']['score_mercicor'])
+
+    def test_calcul_notes_engines(self):
+        """ Test that the columns engine gives the same notes as the QGIS expressions. """
+        layer = self._observation_layer()
+
+        outputs = []
+        for engine in (CalculNotes.ENGINE_COLUMNS, CalculNotes.ENGINE_EXPRESSIONS):
+            params = {
+                'INPUT': layer,
+                'ENGINE': engine,
+                'OUTPUT': 'TEMPORARY_OUTPUT',
+            }
+            results = run("mercicor:calcul_notes", params)
+            outputs.append({feature['id']: feature for feature in results['OUTPUT'].getFeatures()})
+
+        columns, expressions = outputs
+        self.assertSetEqual(set(expressions.keys()), set(columns.keys()))
+        for feature_id, expected in expressions.items():
+            for note in CalculNotes().expressions.keys():
+                with self.subTest(i='{} {}'.format(feature_id, note)):
+                    if expected[note] == NULL:
+                        self.assertEqual(NULL, columns[feature_id][note])
+                    else:
+                        self.assertAlmostEqual(expected[note], columns[feature_id][note])
+
+    def test_calcul_notes_field_case(self):
+        """ Test the columns engine with fields differing only by the case. """
+        fields = ['BSD_RECOUV_COR' if field == 'bsd_recouv_cor' else field for field in CalculNotes().fields]
+        uri = 'None?{}field=NOTE_BSD:double'.format(
+            ''.join('field={}:double&'.format(field) for field in fields))
+        layer = QgsVectorLayer(uri, 'observations', 'memory')
+
+        feature = QgsFeature(layer.fields())
+        for field in fields:
+            if field.lower().startswith('bsd_'):
+                feature.setAttribute(field, 2)
+        with edit(layer):
+            layer.addFeature(feature)
+
+        results = run("mercicor:calcul_notes", {'INPUT': layer, 'OUTPUT': 'TEMPORARY_OUTPUT'})
+        output = results['OUTPUT']
+        self.assertEqual(-1, output.fields().indexOf('note_bsd'))
+
+        feature = next(output.getFeatures())
+        self.assertAlmostEqual(20 / 3, feature['NOTE_BSD'])
+        self.assertAlmostEqual(20 / 3, feature['note_ben'])
+
+    def test_calcul_notes_layer(self):
+        """ Test the update of the notes directly in the geopackage layer, by batch. """
+        layer = self._observation_layer()
+
+        params = {
+            'INPUT': layer,
+            'BATCH_SIZE': 3,
+        }
+        results = run("mercicor:calcul_notes_layer", params)
+        self.assertEqual(8, results['NUMBER_OF_FEATURES'])
+
+        expected = run(
+            "mercicor:calcul_notes",
+            {'INPUT': layer, 'ENGINE': CalculNotes.ENGINE_EXPRESSIONS, 'OUTPUT': 'TEMPORARY_OUTPUT'}
+        )['OUTPUT']
+        expected = {feature['id']: feature for feature in expected.getFeatures()}
+
+        for feature in layer.getFeatures():
+            for note in CalculNotes().expressions.keys():
+                with self.subTest(i='{} {}'.format(feature['id'], note)):
+                    if expected[feature['id']][note] == NULL:
+                        self.assertEqual(NULL, feature[note])
+                    else:
+                        self.assertAlmostEqual(expected[feature['id']][note], feature[note])
+
+    def test_calcul_notes_layer_canceled(self):
+        """ Test that no note is saved if the update of the notes is canceled. """
+        layer = self._observation_layer()
+        with edit(layer):
+            for feature in layer.getFeatures():
+                layer.changeAttributeValue(feature.id(), layer.fields().indexOf('note_pmi'), 100)
+
+        feedback = QgsProcessingFeedback()
+        feedback.cancel()
+        params = {
+            'INPUT': layer,
+            'BATCH_SIZE': 3,
+        }
+        results = run("mercicor:calcul_notes_layer", params, feedback=feedback)
+        self.assertEqual(0, results['NUMBER_OF_FEATURES'])
+        self.assertFalse(layer.isEditable())
+
+        layer.reload()
+        self.assertSetEqual({100}, layer.uniqueValues(layer.fields().indexOf('note_pmi')))
+
+    def test_calcul_notes_dependencies(self):
+        """ Test the notes to update when some indicators are changed. """
+        dependencies = CalculNotes().dependencies()
+        self.assertListEqual(list(CalculNotes().expressions.keys()), list(dependencies.keys()))
+        self.assertIn('bsd_recouv_cor', dependencies['note_ben'])
+        self.assertIn('station_man', dependencies['score_mercicor'])
+        self.assertNotIn('note_bsd', dependencies['note_ben'])
+
+        self.assertListEqual(
+            ['note_pmi', 'score_mercicor'], affected_notes(dependencies, ['pmi_macro_inv']))
+        self.assertListEqual(
+            ['note_ben', 'score_mercicor'], affected_notes(dependencies, ['perc_bsd']))
+
+        # Only the notes depending on pmi_macro_inv, for two features
+        layer = self._observation_layer()
+        with edit(layer):
+            for feature in layer.getFeatures():
+                layer.changeAttributeValue(feature.id(), layer.fields().indexOf('note_bsd'), 100)
+                layer.changeAttributeValue(feature.id(), layer.fields().indexOf('note_pmi'), 100)
+
+        params = {
+            'INPUT': layer,
+            'FEATURE_IDS': '2, 3',
+            'CHANGED_FIELDS': ['pmi_macro_inv'],
+        }
+        results = run("mercicor:calcul_notes_layer", params)
+        self.assertEqual(2, results['NUMBER_OF_FEATURES'])
+
+        index = layer.fields().indexOf('note_bsd')
+        self.assertSetEqual({100}, layer.uniqueValues(index))
+        for feature in layer.getFeatures():
+            with self.subTest(i=feature.id()):
+                if feature.id() in (2, 3):
+                    self.assertAlmostEqual(5, feature['note_pmi'])
+                else:
+                    self.assertEqual(100, feature['note_pmi'])
+
+    def test_calcul_habitat_etat_ecologique(self):
+        """ Test the summary of the observations by habitat. """
+        observations = self._observation_layer()
+        gpkg = observations.source().split('|')[0]
+        habitat = QgsVectorLayer('{}|layername=habitat'.format(gpkg), 'habitat', 'ogr')
+        name = 'habitat_etat_ecologique'
+        hab_etat_ecolo = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+
+        polygons = (
+            # Observations MAN1 and MAN2
+            'POLYGON((45.168 -12.7230, 45.173 -12.7230, 45.173 -12.7222, 45.168 -12.7222, 45.168 -12.7230))',
+            # Observation BSD1
+            'POLYGON((45.1695 -12.7222, 45.1705 -12.7222, 45.1705 -12.7212, 45.1695 -12.7212, '
+            '45.1695 -12.7222))',
+            # No observation
+            'POLYGON((45.0 -12.0, 45.1 -12.0, 45.1 -12.1, 45.0 -12.1, 45.0 -12.0))',
+        )
+        with edit(habitat):
+            for i, wkt in enumerate(polygons):
+                feature = QgsFeature(habitat.fields())
+                feature.setAttribute('id', i + 1)
+                feature.setAttribute('nom', 'nom {}'.format(i + 1))
+                feature.setAttribute('facies', 'facies {}'.format(i + 1))
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                habitat.addFeature(feature)
+
+        join = habitat_observations(habitat, observations, QgsProcessingContext().transformContext())
+        self.assertListEqual([1, 2], list(join.keys()))
+        self.assertListEqual([1, 5], sorted(join[1]))
+        self.assertListEqual([2], join[2])
+
+        params = {
+            'HABITAT': habitat,
+            'OBSERVATIONS': observations,
+            'HABITAT_ETAT_ECOLOGIQUE': hab_etat_ecolo,
+        }
+        os.environ['TESTING_MERCICOR'] = 'True'
+        run("mercicor:calcul_habitat_etat_ecologique", params)
+
+        self.assertEqual(2, hab_etat_ecolo.featureCount())
+        features = {feature['id']: feature for feature in hab_etat_ecolo.getFeatures()}
+
+        feature = features[1]
+        self.assertTrue(feature['station_man'])
+        self.assertEqual(NULL, feature['perc_bsd'])
+        self.assertAlmostEqual(1, feature['man_fragm'])
+        self.assertAlmostEqual(1.5, feature['pmi_div_poi'])
+        self.assertAlmostEqual(5, feature['note_pmi'])
+        self.assertAlmostEqual((10 / 3 + 5) / 2, feature['score_mercicor'])
+
+        feature = features[2]
+        self.assertFalse(feature['station_man'])
+        self.assertAlmostEqual(1, feature['perc_bsd'])
+        self.assertAlmostEqual(2, feature['bsd_recouv_cor'])
+        self.assertEqual(NULL, feature['man_fragm'])
+
+        # A second time, existing features are updated
+        with edit(observations):
+            observations.changeAttributeValue(2, observations.fields().indexOf('bsd_recouv_cor'), 3)
+
+        run("mercicor:calcul_habitat_etat_ecologique", params)
+        self.assertEqual(2, hab_etat_ecolo.featureCount())
+        features = {feature['id']: feature for feature in hab_etat_ecolo.getFeatures()}
+        self.assertAlmostEqual(3, features[2]['bsd_recouv_cor'])
+        self.assertAlmostEqual(1, features[1]['man_fragm'])
+
+        # Only the habitat of the edited observation
+        with edit(observations):
+            observations.changeAttributeValue(2, observations.fields().indexOf('bsd_recouv_cor'), 1)
+            observations.changeAttributeValue(1, observations.fields().indexOf('man_fragm'), 3)
+
+        params['OBSERVATION_IDS'] = '2'
+        run("mercicor:calcul_habitat_etat_ecologique", params)
+        self.assertEqual(2, hab_etat_ecolo.featureCount())
+        features = {feature['id']: feature for feature in hab_etat_ecolo.getFeatures()}
+        self.assertAlmostEqual(1, features[2]['bsd_recouv_cor'])
+        self.assertAlmostEqual(1, features[1]['man_fragm'])
+        del os.environ['TESTING_MERCICOR']
+
+    def test_summarize_observations_missing_field(self):
+        """ Test the summary of the observations without the station_man field. """
+        habitat = QgsVectorLayer('Polygon?crs=epsg:4326&field=id:integer', 'habitat', 'memory')
+        uri = 'Point?crs=epsg:4326&{}'.format(
+            '&'.join('field={}:double'.format(field) for field in CalculNotes().fields))
+        observations = QgsVectorLayer(uri, 'observations', 'memory')
+
+        with self.assertRaises(QgsProcessingException):
+            CalculHabitatEtatEcologique.summarize_observations(
+                habitat, observations, QgsProcessingContext().transformContext(), QgsProcessingFeedback())
+
     def test_habitat_pression_etat_ecologique(self):
         """ Test to add data in the habitat_pression_etat_ecologique layer. """
         pression_layer = QgsVectorLayer(
@@ -82,7 +372,8 @@ class TestCalculsAlgorithms(BaseTestProcessing):
             'HABITAT_PRESSION_ETAT_ECOLOGIQUE_LAYER': hab_pression_etat_ecolo_layer,
         }
         os.environ['TESTING_MERCICOR'] = 'True'
-        run("mercicor:calcul_habitat_pression_etat_ecologique", params)
+        results = run("mercicor:calcul_habitat_pression_etat_ecologique", params)
+        self.assertEqual(0, results['NUMBER_OF_REPAIRED'])
         self.assertEqual(28, hab_pression_etat_ecolo_layer.featureCount())
         self.assertSetEqual({1, 2, 3, 4}, hab_pression_etat_ecolo_layer.uniqueValues(1))  # habitat_id
         self.assertSetEqual(
@@ -91,6 +382,10 @@ class TestCalculsAlgorithms(BaseTestProcessing):
         )  # pression_id
         self.assertSetEqual({1}, hab_pression_etat_ecolo_layer.uniqueValues(3))  # scenario_id
 
+        # The area is stored for the calcul of the pertes
+        for feature in hab_pression_etat_ecolo_layer.getFeatures():
+            self.assertAlmostEqual(feature.geometry().area(), feature['surface'])
+
         # Get 1 pression with type 6 - Emprise
         filter_pression = QgsExpression.createFieldEqualityExpression('type_pression', 6)
         request_pression = QgsFeatureRequest(QgsExpression(filter_pression))
@@ -133,6 +428,33 @@ class TestCalculsAlgorithms(BaseTestProcessing):
         self.assertEqual(28, hab_pression_etat_ecolo_layer.featureCount())
         index = hab_pression_etat_ecolo_layer.fields().indexOf('perc_bsd')
         self.assertSetEqual({0, 11}, hab_pression_etat_ecolo_layer.uniqueValues(index))
+
+        # Only the given scenario, without pression in this scenario
+        index = habitat_layer.fields().indexOf('perc_bsd')
+        with edit(habitat_layer):
+            for feature in habitat_layer.getFeatures():
+                habitat_layer.changeAttributeValue(feature.id(), index, feature['perc_bsd'] + 10)
+
+        params['SCENARIO_ID'] = 2
+        run("mercicor:calcul_habitat_pression_etat_ecologique", params)
+        self.assertEqual(28, hab_pression_etat_ecolo_layer.featureCount())
+        index = hab_pression_etat_ecolo_layer.fields().indexOf('perc_bsd')
+        self.assertSetEqual({0, 11}, hab_pression_etat_ecolo_layer.uniqueValues(index))
+
+        # Outdated features of the scenario are deleted
+        feature = QgsFeature(hab_pression_etat_ecolo_layer.fields())
+        feature.setAttribute('habitat_id', 999)
+        feature.setAttribute('pression_id', 999)
+        feature.setAttribute('scenario_id', 1)
+        with edit(hab_pression_etat_ecolo_layer):
+            hab_pression_etat_ecolo_layer.addFeature(feature)
+        self.assertEqual(29, hab_pression_etat_ecolo_layer.featureCount())
+
+        params['SCENARIO_ID'] = 1
+        params['DELETE_OUTDATED'] = True
+        run("mercicor:calcul_habitat_pression_etat_ecologique", params)
+        self.assertEqual(28, hab_pression_etat_ecolo_layer.featureCount())
+        self.assertSetEqual({0, 21}, hab_pression_etat_ecolo_layer.uniqueValues(index))
         del os.environ['TESTING_MERCICOR']
 
     def test_unicity_facies_name(self):
@@ -183,6 +505,94 @@ class TestCalculsAlgorithms(BaseTestProcessing):
         self.assertSetEqual({'nom 1'}, results['OUTPUT'].uniqueValues(1))
         self.assertSetEqual({'facies 1'}, results['OUTPUT'].uniqueValues(2))
 
+        # A couple three times is reported once, with the detail in the table
+        feature_4 = QgsFeature(layer.fields())
+        feature_4.setAttribute('id', 4)
+        feature_4.setAttribute('nom', 'nom 1')
+        feature_4.setAttribute('facies', 'facies 1')
+        feature_4.setGeometry(QgsGeometry.fromWkt('POINT(3 3)').buffer(1, 20))
+
+        with edit(layer):
+            layer.addFeature(feature_4)
+
+        params['OUTPUT_TABLE'] = 'TEMPORARY_OUTPUT'
+        results = run("mercicor:calcul_unicity_habitat", params)
+        self.assertEqual(2, results['NUMBER_OF_UNIQUE'])
+        self.assertEqual(1, results['NUMBER_OF_NON_UNIQUE'])
+
+        table = results['OUTPUT_TABLE']
+        self.assertEqual(1, table.featureCount())
+        feature = next(table.getFeatures())
+        self.assertEqual('nom 1', feature['nom'])
+        self.assertEqual('facies 1', feature['facies'])
+        self.assertEqual(3, feature['nombre'])
+        self.assertEqual('1, 3, 4', feature['ids'])
+
+    def test_unicity_cache(self):
+        """ Test the cache of the unicity between name and facies. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        layer = QgsVectorLayer('{}|layername=habitat'.format(gpkg), 'habitat', 'ogr')
+        self.assertTrue(layer.isValid())
+
+        with edit(layer):
+            for i, point in enumerate(('POINT(0 0)', 'POINT(1 1)')):
+                feature = QgsFeature(layer.fields())
+                feature.setAttribute('id', i + 1)
+                feature.setAttribute('nom', 'nom {}'.format(i + 1))
+                feature.setAttribute('facies', 'facies {}'.format(i + 1))
+                feature.setGeometry(QgsGeometry.fromWkt(point).buffer(1, 20))
+                layer.addFeature(feature)
+
+        context = QgsProcessingContext()
+        feedback = QgsProcessingFeedback()
+
+        token = change_token(layer)
+        self.assertIsNone(read_verdict(layer, token))
+
+        results = check_unicity(layer, context, feedback)
+        self.assertEqual(0, results['NUMBER_OF_NON_UNIQUE'])
+
+        # The verdict is kept for this token
+        cached = read_verdict(layer, token)
+        self.assertEqual(2, cached['NUMBER_OF_UNIQUE'])
+        self.assertEqual(0, cached['NUMBER_OF_NON_UNIQUE'])
+
+        # A cache hit does not run the unicity algorithm
+        with mock.patch.object(unicity_cache.processing, 'run', wraps=processing.run) as child:
+            results = check_unicity(layer, context, feedback)
+        child.assert_not_called()
+        self.assertEqual(2, results['NUMBER_OF_UNIQUE'])
+        self.assertEqual(0, results['NUMBER_OF_NON_UNIQUE'])
+
+        # Nothing is written in the geopackage
+        connection = sqlite3.connect(gpkg)
+        try:
+            tables = [row[0] for row in connection.execute('SELECT table_name FROM gpkg_contents')]
+        finally:
+            connection.close()
+        self.assertNotIn('cache_unicite_habitat', tables)
+
+        # Renaming a facies changes the token
+        with edit(layer):
+            layer.changeAttributeValue(2, layer.fields().indexOf('facies'), 'facies 1')
+            layer.changeAttributeValue(2, layer.fields().indexOf('nom'), 'nom 1')
+
+        self.assertNotEqual(token, change_token(layer))
+        self.assertIsNone(read_verdict(layer, change_token(layer)))
+
+        # A cache miss runs the unicity algorithm
+        with mock.patch.object(unicity_cache.processing, 'run', wraps=processing.run) as child:
+            results = check_unicity(layer, context, feedback)
+        self.assertEqual(1, child.call_count)
+        self.assertEqual(1, results['NUMBER_OF_NON_UNIQUE'])
+        self.assertEqual(1, read_verdict(layer, change_token(layer))['NUMBER_OF_NON_UNIQUE'])
+
+        # No cache for a layer with pending edits
+        layer.startEditing()
+        layer.changeAttributeValue(2, layer.fields().indexOf('facies'), 'facies 2')
+        self.assertIsNone(change_token(layer))
+        layer.rollBack()
+
     def test_expressions_calcul_perte(self):
         """ Test that expressions are valid. """
         gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
@@ -206,3 +616,139 @@ class TestCalculsAlgorithms(BaseTestProcessing):
                 for field in CalculPertes().fields[note]:
                     with self.subTest(i=field):
                         self.assertGreater(layer.fields().indexOf(field), -1, field)
+
+    @staticmethod
+    def _calcul_pertes_gains(project_type: ProjectType, rows: list, layer: QgsVectorLayer = None) -> dict:
+        """ Internal function to run the calcul of the pertes or gains.
+
+        :param rows: Rows of the habitat impact layer, with the habitat ID, the scenario ID, the value of
+            all notes, the value of note_bsd, the surface and the geometry.
+        :param layer: Habitat impact layer, the layer from the geopackage by default.
+        :return: The scenario features, by ID.
+        """
+        label = project_type.label
+        gpkg = plugin_test_data_path('main_geopackage_empty_{}.gpkg'.format(label), copy=True)
+        name = 'habitat_etat_ecologique'
+        hab_etat_ecolo = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+        name = project_type.couche_scenario_impact
+        scenario = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+        if not layer:
+            name = project_type.couche_habitat_impact_etat_ecologique
+            layer = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+
+        notes = [formula[1] for formula in CalculPertes().fields.values()]
+
+        # The habitat 2 has no note_bsd
+        with edit(hab_etat_ecolo):
+            for habitat_id, value in ((1, 5), (2, 4)):
+                feature = QgsFeature(hab_etat_ecolo.fields())
+                feature.setAttribute('id', habitat_id)
+                for note in notes:
+                    feature.setAttribute(note, value)
+                if habitat_id == 2:
+                    feature.setAttribute('note_bsd', NULL)
+                hab_etat_ecolo.addFeature(feature)
+
+        # The scenario 3 has no feature
+        with edit(scenario):
+            for scenario_id in (1, 2, 3):
+                feature = QgsFeature(scenario.fields())
+                feature.setAttribute('id', scenario_id)
+                feature.setAttribute('nom', 'scénario {}'.format(scenario_id))
+                scenario.addFeature(feature)
+
+        with edit(layer):
+            for habitat_id, scenario_id, value, note_bsd, surface, wkt in rows:
+                feature = QgsFeature(layer.fields())
+                feature.setAttribute('habitat_id', habitat_id)
+                feature.setAttribute('scenario_id', scenario_id)
+                for note in notes:
+                    feature.setAttribute(note, value)
+                feature.setAttribute('note_bsd', note_bsd)
+                if layer.fields().indexOf('surface') >= 0:
+                    feature.setAttribute('surface', surface)
+                feature.setGeometry(QgsGeometry.fromWkt(wkt))
+                layer.addFeature(feature)
+
+        join_habitat = QgsVectorLayerJoinInfo()
+        join_habitat.setJoinFieldName('id')
+        join_habitat.setJoinLayerId(hab_etat_ecolo.id())
+        join_habitat.setTargetFieldName('habitat_id')
+        join_habitat.setPrefix('hab_')
+        join_habitat.setJoinLayer(hab_etat_ecolo)
+        layer.addJoin(join_habitat)
+
+        params = {
+            'HABITAT_{}_ETAT_ECOLOGIQUE'.format(label.upper()): layer,
+            'SCENARIO_{}'.format(label.upper()): scenario,
+        }
+        os.environ['TESTING_MERCICOR'] = 'True'
+        try:
+            run("mercicor:calcul_{}".format(label), params)
+        finally:
+            del os.environ['TESTING_MERCICOR']
+
+        return {feature['id']: feature for feature in scenario.getFeatures()}
+
+    def test_calcul_pertes_gains(self):
+        """ Test the sums of the pertes and gains by scenario. """
+        # The surface is used, not the area of the geometry
+        square = 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'
+        rows = [
+            (1, 1, 3, 3, 10, square),
+            # The note_bsd of the habitat 2 is NULL
+            (2, 1, 1, 1, 100, square),
+            # The note_bsd of the row is NULL
+            (1, 2, 2, NULL, 1, square),
+        ]
+        for project_type, sign in ((ProjectType.Pression, 1), (ProjectType.Compensation, -1)):
+            with self.subTest(i=project_type.label):
+                scenarios = self._calcul_pertes_gains(project_type, rows)
+                calcul_type = project_type.calcul_type
+                self.assertEqual(3, len(scenarios))
+                for note in CalculPertes().fields.keys():
+                    field = '{}_{}'.format(calcul_type, note)
+                    if note == 'bsd':
+                        # (5 - 3) * 10, the other notes_bsd are NULL
+                        self.assertAlmostEqual(sign * 20, scenarios[1][field], msg=field)
+                        self.assertAlmostEqual(0, scenarios[2][field], msg=field)
+                    else:
+                        # (5 - 3) * 10 + (4 - 1) * 100
+                        self.assertAlmostEqual(sign * 320, scenarios[1][field], msg=field)
+                        # (5 - 2) * 1
+                        self.assertAlmostEqual(sign * 3, scenarios[2][field], msg=field)
+                    self.assertAlmostEqual(0, scenarios[3][field], msg=field)
+
+    def test_calcul_pertes_null_surface(self):
+        """ Test the pertes with a NULL surface, read from the geometry. """
+        rows = [
+            (1, 1, 3, 3, 10, 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'),
+            (1, 1, 3, 3, NULL, 'POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))'),
+        ]
+        scenarios = self._calcul_pertes_gains(ProjectType.Pression, rows)
+        for note in CalculPertes().fields.keys():
+            # (5 - 3) * 10 + (5 - 3) * 4
+            self.assertAlmostEqual(28, scenarios[1]['perte_{}'.format(note)], msg=note)
+
+    def test_calcul_pertes_without_surface(self):
+        """ Test the pertes with a table without the surface field, from the geometry. """
+        notes = ''.join(
+            'field={}:double&'.format(formula[1]) for formula in CalculPertes().fields.values())
+        layer = QgsVectorLayer(
+            'MultiPolygon?crs=epsg:32738&field=habitat_id:integer&field=scenario_id:integer&{}'
+            'index=yes'.format(notes),
+            'habitat_pression_etat_ecologique',
+            'memory')
+        self.assertEqual(-1, layer.fields().indexOf('surface'))
+
+        rows = [
+            (1, 1, 3, 3, 10, 'POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))'),
+            (2, 2, 1, 1, 100, 'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))'),
+        ]
+        scenarios = self._calcul_pertes_gains(ProjectType.Pression, rows, layer)
+        for note in CalculPertes().fields.keys():
+            field = 'perte_{}'.format(note)
+            # (5 - 3) * 4
+            self.assertAlmostEqual(8, scenarios[1][field], msg=field)
+            # (4 - 1) * 1, the note_bsd of the habitat 2 is NULL
+            self.assertAlmostEqual(0 if note == 'bsd' else 3, scenarios[2][field], msg=field)
@@ -7,6 +7,7 @@ from qgis.core import (
     QgsPointXY,
     QgsProcessingContext,
     QgsProcessingException,
+    QgsProcessingFeedback,
     QgsProject,
     QgsRectangle,
     QgsVectorLayer,
@@ -110,6 +111,41 @@ class TestImportAlgorithms(BaseTestProcessing):
         else:
             self.assertEqual(str(context.exception), 'Valeur inconnue pour la pression : 10')
 
+    def test_import_pressure_canceled(self):
+        """ Test that a canceled import of pressure data does not keep the scenario. """
+        layer_to_import = QgsVectorLayer(
+            'MultiPolygon?crs=epsg:2154&field=id:integer&field=pression:integer&index=yes',
+            'polygon',
+            'memory')
+        with edit(layer_to_import):
+            feature = QgsFeature(layer_to_import.fields())
+            feature.setGeometry(QgsGeometry.fromWkt('MULTIPOLYGON (((0 0, 5 0, 5 5, 0 5, 0 0)))'))
+            feature.setAttributes([1, 1])
+            layer_to_import.addFeature(feature)
+
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        pression_layer = QgsVectorLayer('{}|layername=pression'.format(gpkg), 'test', 'ogr')
+        scenario_pression_layer = QgsVectorLayer(
+            '{}|layername=scenario_pression'.format(gpkg), 'test scenario', 'ogr')
+        count = pression_layer.featureCount()
+        count_scenario = scenario_pression_layer.featureCount()
+
+        feedback = QgsProcessingFeedback()
+        feedback.cancel()
+        params = {
+            "INPUT_LAYER": layer_to_import,
+            "PRESSION_FIELD": 'pression',
+            "SCENARIO_NAME": 'scenario',
+            "SCENARIO_LAYER": scenario_pression_layer,
+            "APPLY_CALCUL_HABITAT_PRESSION_ETAT_ECOLOGIQUE": False,
+            "OUTPUT_LAYER": pression_layer,
+        }
+        run("mercicor:import_donnees_pression", params, feedback=feedback)
+
+        self.assertEqual(count, pression_layer.featureCount())
+        self.assertEqual(count_scenario, scenario_pression_layer.featureCount())
+        self.assertEqual('', pression_layer.subsetString())
+
     def test_import_pressure_data(self):
         """ Test to import pressure data. """
         project = QgsProject()
@@ -190,15 +226,22 @@ class TestImportAlgorithms(BaseTestProcessing):
 
         self.assertEqual(1, habitat_layer.featureCount())
 
+        # The habitat is edited with an invalid geometry, repaired by the calcul
+        x = 700000  # NOQA VNE001
+        y = 7000000  # NOQA VNE001
+        bowtie = QgsGeometry.fromWkt(
+            'MULTIPOLYGON((({x} {y}, {x2} {y2}, {x2} {y}, {x} {y2}, {x} {y})))'.format(
+                x=x, y=y, x2=x + 10, y2=y + 5))
+        self.assertFalse(bowtie.isGeosValid())
+        with edit(habitat_layer):
+            habitat_layer.changeGeometry(next(habitat_layer.getFeatures()).id(), bowtie)
+
         # import pression
         layer_to_import = QgsVectorLayer(
             'MultiPolygon?crs=epsg:2154&field=id:integer&field=pression:integer&index=yes',
             'polygon',
             'memory')
 
-        x = 700000  # NOQA VNE001
-        y = 7000000  # NOQA VNE001
-
         with edit(layer_to_import):
             feature = QgsFeature(layer_to_import.fields())
             feature.setGeometry(QgsGeometry.fromMultiPolygonXY(
@@ -232,7 +275,10 @@ class TestImportAlgorithms(BaseTestProcessing):
             "HABITAT_PRESSION_LAYER": habitat_pression_layer,
             "OUTPUT_LAYER": pression_layer,
         }
-        run("mercicor:import_donnees_pression", params)
+        results = run("mercicor:import_donnees_pression", params)
+
+        # The habitat repaired by the calcul is counted
+        self.assertEqual(1, results['NUMBER_OF_REPAIRED'])
 
         # Couche pression
         self.assertEqual(1, pression_layer.featureCount())
@@ -282,8 +328,76 @@ class TestImportAlgorithms(BaseTestProcessing):
         self.assertEqual(1, len(target_layer.renderer().categories()))
         self.assertEqual('zone 1', target_layer.renderer().categories()[0].label())
 
-    def test_import_observation_exist(self):
-        """ Test to retrieve a specific observation feature. """
+    def test_import_habitat_data_repair(self):
+        """ Test to import habitat data with an invalid geometry. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        target_layer = QgsVectorLayer('{}|layername={}'.format(gpkg, 'habitat'), 'habitat', 'ogr')
+        self.assertEqual(0, target_layer.featureCount())
+
+        import_layer = QgsVectorLayer(
+            'Polygon?crs={}&field=nom:string&field=facies:string'.format(target_layer.crs().authid()),
+            'habitat',
+            'memory')
+        wkt = [
+            # Polygon en forme de nœud papillon, invalide
+            ('zone 1', 'POLYGON((0 0, 10 10, 10 0, 0 10, 0 0))'),
+            ('zone 1', 'POLYGON((20 0, 30 0, 30 10, 20 10, 20 0))'),
+            ('zone 2', 'POLYGON((40 0, 50 0, 50 10, 40 10, 40 0))'),
+        ]
+        with edit(import_layer):
+            for name, polygon in wkt:
+                feature = QgsFeature(import_layer.fields())
+                feature.setAttribute('nom', name)
+                feature.setAttribute('facies', 'bon')
+                feature.setGeometry(QgsGeometry.fromWkt(polygon))
+                import_layer.addFeature(feature)
+
+        params = {
+            "INPUT_LAYER": import_layer,
+            "FACIES_FIELD": 'facies',
+            "NAME_FIELD": 'nom',
+            "OUTPUT_LAYER": target_layer,
+        }
+        results = run("mercicor:import_donnees_habitat", params)
+        self.assertEqual(1, results['NUMBER_OF_REPAIRED'])
+
+        self.assertEqual(2, target_layer.featureCount())
+        for feature in target_layer.getFeatures():
+            self.assertTrue(feature.geometry().isGeosValid())
+            if feature['nom'] == 'zone 1':
+                # Les deux triangles et le carré
+                self.assertEqual(150, feature.geometry().area())
+            else:
+                self.assertEqual(100, feature.geometry().area())
+
+    def test_import_habitat_data_pending_edits(self):
+        """ Test the import is refused if the destination layer has pending edits. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        target_layer = QgsVectorLayer('{}|layername={}'.format(gpkg, 'habitat'), 'habitat', 'ogr')
+        import_layer = QgsVectorLayer(plugin_test_data_path('import_habitat.geojson'), 'habitat', 'ogr')
+
+        feature = QgsFeature(target_layer.fields())
+        feature.setAttribute('nom', 'edition en cours')
+        feature.setGeometry(QgsGeometry.fromWkt('POINT(0 0)').buffer(1, 5))
+        target_layer.startEditing()
+        target_layer.addFeature(feature)
+
+        params = {
+            "INPUT_LAYER": import_layer,
+            "FACIES_FIELD": 'facies',
+            "NAME_FIELD": 'nom',
+            "OUTPUT_LAYER": target_layer,
+        }
+        with self.assertRaises(QgsProcessingException):
+            run("mercicor:import_donnees_habitat", params)
+
+        # The edits of the user are still pending, nothing is saved
+        self.assertTrue(target_layer.isModified())
+        target_layer.rollBack()
+        self.assertEqual(0, target_layer.featureCount())
+
+    def test_import_observation_update(self):
+        """ Test to update an existing observation from its ID, without geometry. """
         gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
         name = 'observations'
         observations = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
@@ -295,8 +409,30 @@ class TestImportAlgorithms(BaseTestProcessing):
         with edit(observations):
             observations.addFeature(feature)
 
-        self.assertTrue(ImportObservationData.observation_exists(observations, 1)[0])
-        self.assertFalse(ImportObservationData.observation_exists(observations, 100)[0])
+        self.assertDictEqual({1: 1}, ImportObservationData.existing_observations(observations))
+
+        layer_to_import = QgsVectorLayer(
+            'None?field=id:integer&field=nom_station:string(20)&field=note_man:integer', 'obs', 'memory')
+        feature = QgsFeature(layer_to_import.fields())
+        feature.setAttribute('id', 1)
+        feature.setAttribute('nom_station', 'Nouveau nom')
+        feature.setAttribute('note_man', 5)
+        with edit(layer_to_import):
+            layer_to_import.addFeature(feature)
+
+        params = {
+            "INPUT_LAYER": layer_to_import,
+            "OUTPUT_LAYER": observations,
+        }
+        results = run("mercicor:import_donnees_observation", params)
+        self.assertEqual('1', results['OBSERVATION_IDS'])
+        self.assertEqual(1, observations.featureCount())
+
+        # The attributes are updated, the geometry is kept
+        feature = observations.getFeature(1)
+        self.assertEqual('Nouveau nom', feature['nom_station'])
+        self.assertEqual(5, feature['note_man'])
+        self.assertEqual('Point (0 0)', feature.geometry().asWkt())
 
     def test_import_observations(self):
         """ Test to import observations with a geometry from a vector layer. """
@@ -330,8 +466,9 @@ class TestImportAlgorithms(BaseTestProcessing):
             "INPUT_LAYER": layer_to_import,
             "OUTPUT_LAYER": observations,
         }
-        run("mercicor:import_donnees_observation", params)
+        results = run("mercicor:import_donnees_observation", params)
         self.assertEqual(observations.featureCount(), 1)
+        self.assertEqual('1', results['OBSERVATION_IDS'])
 
         # Test geom
         self.assertAlmostEqual(int(observations.extent().center().x()), 518455, 0)
@@ -370,3 +507,115 @@ class TestImportAlgorithms(BaseTestProcessing):
         self.assertSetEqual(observations.uniqueValues(0), {1})
         index = observations.fields().indexOf('note_man')
         self.assertSetEqual(observations.uniqueValues(index), {1000})
+
+        # Update and create in the same import
+        feature = QgsFeature(layer_to_import.fields())
+        feature.setAttribute('id', 2)
+        feature.setAttribute('nom_station', 'TEST 02')
+        feature.setAttribute('note_man', 20)
+        feature.setAttribute('another_field', 20)
+        feature.setAttribute('latitude', -12.72)
+        feature.setAttribute('longitude', 45.17)
+        with edit(layer_to_import):
+            layer_to_import.addFeature(feature)
+            layer_to_import.changeAttributeValue(feature_id, note_man_index, 100)
+
+        results = run("mercicor:import_donnees_observation", params)
+        self.assertEqual(observations.featureCount(), 2)
+        self.assertEqual('1,2', results['OBSERVATION_IDS'])
+        self.assertSetEqual(observations.uniqueValues(0), {1, 2})
+        self.assertSetEqual(observations.uniqueValues(index), {100, 20})
+
+    def test_import_observations_without_id(self):
+        """ Test to import observations without ID, then update the ecological state of their habitat. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        name = 'observations'
+        observations = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+        habitat = QgsVectorLayer('{}|layername=habitat'.format(gpkg), 'habitat', 'ogr')
+        name = 'habitat_etat_ecologique'
+        hab_etat_ecolo = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+
+        # The habitat around the imported observations
+        feature = QgsFeature(habitat.fields())
+        feature.setAttribute('id', 1)
+        feature.setAttribute('nom', 'nom 1')
+        feature.setAttribute('facies', 'facies 1')
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(518455, 8593822)).buffer(1000, 5))
+        with edit(habitat):
+            habitat.addFeature(feature)
+
+        layer_to_import = QgsVectorLayer(
+            'None?'
+            'field=id:integer&'
+            'field=nom_station:string(20)&'
+            'field=bsd_recouv_cor:double&'
+            'field=latitude:double&'
+            'field=longitude:double',
+            'obs',
+            'memory')
+        with edit(layer_to_import):
+            for name, value in (('TEST 01', 1), ('TEST 02', 3)):
+                feature = QgsFeature(layer_to_import.fields())
+                feature.setAttribute('nom_station', name)
+                feature.setAttribute('bsd_recouv_cor', value)
+                feature.setAttribute('latitude', -12.72)
+                feature.setAttribute('longitude', 45.17)
+                layer_to_import.addFeature(feature)
+
+        params = {
+            "INPUT_LAYER": layer_to_import,
+            "OUTPUT_LAYER": observations,
+        }
+        results = run("mercicor:import_donnees_observation", params)
+
+        # Each row without ID is a new observation
+        self.assertEqual(2, observations.featureCount())
+        self.assertSetEqual({'TEST 01', 'TEST 02'}, observations.uniqueValues(1))
+        fids = sorted(feature.id() for feature in observations.getFeatures())
+        self.assertListEqual(fids, sorted(int(fid) for fid in results['OBSERVATION_IDS'].split(',')))
+
+        # Only the habitats of the imported observations
+        params = {
+            'HABITAT': habitat,
+            'OBSERVATIONS': observations,
+            'HABITAT_ETAT_ECOLOGIQUE': hab_etat_ecolo,
+            'OBSERVATION_IDS': results['OBSERVATION_IDS'],
+        }
+        run("mercicor:calcul_habitat_etat_ecologique", params)
+        self.assertEqual(1, hab_etat_ecolo.featureCount())
+        feature = next(hab_etat_ecolo.getFeatures())
+        self.assertEqual(1, feature['id'])
+        self.assertAlmostEqual(2, feature['bsd_recouv_cor'])
+
+    def test_import_observations_pending_edits(self):
+        """ Test the import of observations is refused if the layer has pending edits. """
+        gpkg = plugin_test_data_path('main_geopackage_empty_pression.gpkg', copy=True)
+        name = 'observations'
+        observations = QgsVectorLayer('{}|layername={}'.format(gpkg, name), name, 'ogr')
+
+        layer_to_import = QgsVectorLayer(
+            'None?field=id:integer&field=nom_station:string(20)', 'obs', 'memory')
+        feature = QgsFeature(layer_to_import.fields())
+        feature.setAttribute('id', 1)
+        feature.setAttribute('nom_station', 'TEST 01')
+        with edit(layer_to_import):
+            layer_to_import.addFeature(feature)
+
+        feature = QgsFeature(observations.fields())
+        feature.setAttribute('id', 2)
+        feature.setAttribute('nom_station', 'Edition en cours')
+        feature.setGeometry(QgsGeometry.fromWkt('POINT(0 0)'))
+        observations.startEditing()
+        observations.addFeature(feature)
+
+        params = {
+            "INPUT_LAYER": layer_to_import,
+            "OUTPUT_LAYER": observations,
+        }
+        with self.assertRaises(QgsProcessingException):
+            run("mercicor:import_donnees_observation", params)
+
+        # The edits of the user are still pending, nothing is saved
+        self.assertTrue(observations.isModified())
+        observations.rollBack()
+        self.assertEqual(0, observations.featureCount())
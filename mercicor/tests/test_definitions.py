@@ -2,6 +2,7 @@
 
 import unittest
 
+from mercicor.definitions.data_models import data_model, field_names
 from mercicor.definitions.project_type import ProjectType
 
 __copyright__ = "Copyright 2021, 3Liz"
@@ -41,3 +42,13 @@ class TestDefinitions(unittest.TestCase):
             ],
             projet_compensation.layers
         )
+
+    def test_data_model(self):
+        """ Test the data models read from the CSV files. """
+        fields = data_model('observations')
+        self.assertEqual('id', fields[0].name)
+        self.assertEqual(4, fields[0].field_type)
+        self.assertEqual(('id', 'nom_station', 'station_man'), field_names('observations')[0:3])
+
+        # The CSV file is read only once
+        self.assertIs(fields, data_model('observations'))